@@ -0,0 +1,116 @@
+# Compares hand-written scrape() methods with the same extraction declared as a Schema.
+#
+#     python -m benchmarks.extract [--restaurants 500] [--items 40] [--rounds 20]
+
+import argparse
+import timeit
+import lxml.html
+
+from cyborg import Scraper, Schema, Field, Nested
+from cyborg.extract import trim_whitespace, strip
+from cyborg.requester import Response
+
+
+def takeaway_page(restaurants):
+    divs = "".join(
+        '<div class="restaurant{0}"><h2><a data-restaurant-id="{1}" href="/menu/{1}">Takeaway {1}</a></h2>'
+        '<p class="cuisine">Chicken, Pizza</p></div>'.format(" offlineRestaurant" if i % 10 == 0 else "", i)
+        for i in range(restaurants)
+    )
+    return "<html><body>{0}</body></html>".format(divs)
+
+
+def menu_page(items):
+    products = "".join(
+        '<li class="addItemButton"><h4> Wings {0} </h4><div class="item-price">£{0}.50</div></li>'.format(i)
+        for i in range(items)
+    )
+    sections = "".join(
+        '<section><div><a class="category-header-link">Category {0}</a></div>'
+        '<ul class="menu-category-products">{1}</ul></section>'.format(i, products)
+        for i in range(10)
+    )
+    return ('<html><body><div class="restInfoAddress"> 1   High  Street </div>'
+            '<h1 class="restaurant-name">Takeaway</h1>{0}</body></html>'.format(sections))
+
+
+class HandTakeawayScraper(Scraper):
+    def scrape(self, data, response):
+        for place_div in response.find("div.restaurant"):
+            if place_div.has_class("offlineRestaurant"):
+                continue
+            header_link = place_div.get("h2 a")
+            yield {"id": int(header_link.attr["data-restaurant-id"])}, header_link.attr["href"]
+
+
+class SchemaTakeawayScraper(Scraper):
+    SCHEMA = Schema(
+        root="div.restaurant:not(.offlineRestaurant)",
+        fields={"id": Field("h2 a", attr="data-restaurant-id", normalize=int)},
+        url=Field("h2 a", attr="href")
+    )
+
+
+def price(text):
+    return text.replace("£", "").replace("from", "").strip()
+
+
+class HandMenuScraper(Scraper):
+    def scrape(self, data, response):
+        menu = []
+        for header in response.find("a.category-header-link"):
+            section = header.parent.parent
+            products = []
+            for list_item in section.find("ul.menu-category-products > li"):
+                if list_item.has_class("addItemButton"):
+                    products.append({"name": list_item.get("h4").text.strip(),
+                                     "price": price(list_item.get("div.item-price").text)})
+            menu.append({"category": header.text, "products": products})
+        yield {"name": response.get(".restaurant-name").text,
+               "address": self.trim_whitespace(response.get(".restInfoAddress").text),
+               "menu": menu}, None
+
+
+class SchemaMenuScraper(Scraper):
+    SCHEMA = Schema({
+        "name": ".restaurant-name",
+        "address": Field(".restInfoAddress", normalize=trim_whitespace),
+        "menu": Nested("section", {
+            "category": "a.category-header-link",
+            "products": Nested("ul.menu-category-products > li.addItemButton", {
+                "name": Field("h4", normalize=strip),
+                "price": Field("div.item-price", normalize=price)
+            })
+        })
+    })
+
+
+def run(name, page, hand, schema, rounds):
+    document = lxml.html.fromstring(page)
+    response = Response(None, page, "html", node=document)
+
+    def scrape(scraper_cls):
+        scraper = scraper_cls(None, None, None, None)
+        return lambda: list(scraper.scrape({}, response))
+
+    assert scrape(hand)() == scrape(schema)(), "{0}: the scrapers disagree".format(name)
+
+    hand_time = min(timeit.repeat(scrape(hand), number=rounds, repeat=3)) / rounds
+    schema_time = min(timeit.repeat(scrape(schema), number=rounds, repeat=3)) / rounds
+    print("{0:<10s} hand-written: {1:8.2f}ms  schema: {2:8.2f}ms  speedup: {3:.1f}x".format(
+        name, hand_time * 1000, schema_time * 1000, hand_time / schema_time))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--restaurants", type=int, default=500)
+    parser.add_argument("--items", type=int, default=40)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    run("takeaways", takeaway_page(args.restaurants), HandTakeawayScraper, SchemaTakeawayScraper, args.rounds)
+    run("menu", menu_page(args.items), HandMenuScraper, SchemaMenuScraper, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
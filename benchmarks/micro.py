@@ -0,0 +1,48 @@
+# Microbenchmarks of the hot paths in handling a page: parsing, building a Response and querying it.
+#
+#     python -m benchmarks.micro [--items 30] [--padding 0]
+
+import argparse
+import timeit
+from multidict import CIMultiDict
+
+from cyborg.requester import Response, parse_html
+from benchmarks.mocksite import MockSite
+
+
+def bench(name, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print("{0:<40s} {1:>10.1f}us {2:>12.0f}/s".format(name, best * 1e6, 1 / best))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=30)
+    parser.add_argument("--padding", type=int, default=0)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    page = MockSite(items=args.items, padding=args.padding).menu_page(1)
+    headers = CIMultiDict({"Content-Type": "text/html; charset=utf-8"})
+    node, _ = parse_html(page)
+    response = Response(None, page, "html", node=node)
+    item = response.find("li.addItemButton")[0]
+    number = args.number
+
+    print("Menu page of {0} bytes with {1} items".format(len(page), args.items))
+    bench("parse_html", lambda: parse_html(page), number)
+    bench("Response() from headers", lambda: Response(None, page, headers=headers), number * 10)
+    bench("Response() sniffing the body", lambda: Response(None, page, headers={}), number * 10)
+    bench("Response() and parse", lambda: Response(None, page, headers=headers).document, number)
+    bench("Selector.find li.addItemButton", lambda: response.find("li.addItemButton"), number)
+    bench("Selector.get .restaurant-name", lambda: response.get(".restaurant-name").text, number * 10)
+    bench("Selector.texts div.item-price", lambda: response.texts("div.item-price"), number)
+    bench("Selector.attrs li class", lambda: response.attrs("li", "class"), number)
+    bench("Selector.has_class", lambda: item.has_class("addItemButton"), number * 100)
+    bench("menu loop (find, get, text per item)", lambda: [
+        (li.get("h4").text, li.get("div.item-price").text) for li in response.find("ul.menu-category-products > li")
+    ], number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# A local site shaped like the pages the example just-eat scrapers expect, with configurable size, latency, error
+# rate and fan-out. It can be started on its own to point other scrapers at:
+#
+#     python -m benchmarks.mocksite --port 8080 --latency 0.05 --error-rate 0.01
+
+import argparse
+import asyncio
+import multiprocessing
+import random
+import socket
+import time
+from aiohttp import web
+
+
+class MockSite(object):
+    def __init__(self, areas=5, takeaways=20, items=30, padding=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 restaurants=None, seed=0):
+        # Takeaways are picked from `restaurants` ids, so different areas list some of the same takeaways
+        self.areas = areas
+        self.takeaways = takeaways
+        self.items = items
+        self.padding = padding
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.restaurants = restaurants or areas * takeaways
+        self.seed = seed
+        self.random = random.Random(seed)
+
+    def area_page(self, cuisine):
+        links = "".join('<a href="/{0}/area-{1}">Area {1}</a>'.format(cuisine, idx) for idx in range(self.areas))
+        return '<html><body><div class="links">{0}</div></body></html>'.format(links)
+
+    def takeaway_page(self, cuisine, area):
+        # Seeded by the page, so a page lists the same takeaways every time it is fetched
+        picker = random.Random("{0}/{1}/{2}".format(self.seed, cuisine, area))
+        ids = picker.sample(range(self.restaurants), min(self.takeaways, self.restaurants))
+        divs = "".join(
+            '<div class="restaurant{0}"><h2><a data-restaurant-id="{1}" href="/menu/{1}">Takeaway {1}</a></h2>'
+            '<p class="cuisine">{2}</p></div>'.format(" offlineRestaurant" if idx % 20 == 19 else "", rid, cuisine)
+            for idx, rid in enumerate(ids)
+        )
+        return "<html><body>{0}</body></html>".format(divs)
+
+    def menu_page(self, restaurant):
+        products = "".join(
+            '<li class="addItemButton"><h4 class="itemName"> Item {0} </h4>'
+            '<div class="item-price">£{1}.{2:02d}</div></li>'.format(idx, idx % 15 + 1, idx * 7 % 100)
+            for idx in range(self.items)
+        )
+        return (
+            '<html><body><div class="restInfoAddress"> {0} High   Street </div>'
+            '<h1 class="restaurant-name">Takeaway {0}</h1>'
+            '<section><div><a class="category-header-link">Chicken dishes</a></div>'
+            '<ul class="menu-category-products">{1}</ul></section>'
+            '<div class="padding">{2}</div></body></html>'.format(restaurant, products, "x" * self.padding)
+        )
+
+    async def respond(self, render, *args):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0))
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.Response(status=500, text="Server error")
+        return web.Response(text=render(*args), content_type="text/html")
+
+    async def area(self, request):
+        return await self.respond(self.area_page, request.match_info["cuisine"])
+
+    async def takeaway(self, request):
+        return await self.respond(self.takeaway_page, request.match_info["cuisine"], int(request.match_info["area"]))
+
+    async def menu(self, request):
+        return await self.respond(self.menu_page, int(request.match_info["restaurant"]))
+
+    def application(self):
+        app = web.Application()
+        app.router.add_get("/{cuisine}-takeaways", self.area)
+        app.router.add_get("/{cuisine}/area-{area:\\d+}", self.takeaway)
+        app.router.add_get("/menu/{restaurant:\\d+}", self.menu)
+        return app
+
+    async def serve(self, host, port):
+        runner = web.AppRunner(self.application(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    def run(self, host="127.0.0.1", port=8080):
+        asyncio.run(self.serve(host, port))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_in_process(site, host="127.0.0.1", port=None):
+    # Serves the site from another process, so its CPU time is not counted against the scraper being measured
+    port = port or free_port()
+    process = multiprocessing.Process(target=site.run, args=(host, port), daemon=True)
+    process.start()
+
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            break
+        except OSError:
+            if time.time() > deadline:
+                process.terminate()
+                raise RuntimeError("Mock site did not start")
+            time.sleep(0.05)
+    return process, "http://{0}:{1}".format(host, port)
+
+
+def add_arguments(parser):
+    parser.add_argument("--areas", type=int, default=5, help="areas listed for every cuisine")
+    parser.add_argument("--takeaways", type=int, default=20, help="takeaways listed in every area")
+    parser.add_argument("--restaurants", type=int, default=None, help="distinct takeaways, fewer gives more duplicates")
+    parser.add_argument("--items", type=int, default=30, help="items on every menu")
+    parser.add_argument("--padding", type=int, default=0, help="extra bytes added to every menu")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra or less latency, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of responses that are a 500")
+
+
+def site_from_arguments(args):
+    return MockSite(areas=args.areas, takeaways=args.takeaways, items=args.items, padding=args.padding,
+                    latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                    restaurants=args.restaurants)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print("Serving on http://{0}:{1}/".format(args.host, args.port))
+    site_from_arguments(args).run(args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
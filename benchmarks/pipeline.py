@@ -0,0 +1,115 @@
+# End to end throughput of the example AreaScraper -> TakeawayScraper -> unique -> MenuScraper pipeline against
+# the local mock site:
+#
+#     python -m benchmarks.pipeline --cuisines 5 --areas 10 --takeaways 30 --latency 0.02 --error-rate 0.01
+#
+# With --incremental state.db a second run over the same site only outputs changes and skips unchanged menus.
+# Pages are remembered by URL, so give both runs the same --port.
+
+import argparse
+import asyncio
+import logging
+import resource
+import time
+
+from cyborg import Pipeline
+from cyborg.metrics import Exporter
+from example.scrapers.justeat.area import AreaScraper
+from example.scrapers.justeat.takeaway import TakeawayScraper
+from example.scrapers.justeat.menu import MenuScraper
+from benchmarks.mocksite import add_arguments, site_from_arguments, start_in_process
+
+
+class Collector(Exporter):
+    # Keeps the final metrics of the run
+    def __init__(self):
+        self.snapshot = None
+
+    async def run(self, metrics):
+        await asyncio.get_running_loop().create_future()
+
+    def close(self, metrics):
+        self.snapshot = metrics.snapshot()
+
+
+def cpu_time():
+    # Includes parser processes once they have exited. The mock site is only reaped after the run.
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def build(args, host, collector, output):
+    pipeline = Pipeline()\
+        .set_host(host)\
+        .feed(["cuisine{0}".format(idx) for idx in range(args.cuisines)])\
+        .pipe(AreaScraper)\
+        .pipe(TakeawayScraper)\
+        .unique("id")\
+        .pipe(MenuScraper)\
+        .defaults(workers=args.workers)\
+        .parser(args.parser)\
+        .export(collector)\
+        .output(output)
+    if args.connections:
+        pipeline.connections(per_host=args.connections)
+    if args.incremental:
+        pipeline.incremental(args.incremental)
+    return pipeline
+
+
+def report(snapshot, elapsed, outputs, cpu, rss):
+    requests = snapshot["requests"]
+    print("{0} pages in {1:.2f}s: {2:.1f} pages/s, {3} items output, {4:.1f} MB downloaded".format(
+        requests, elapsed, requests / elapsed, outputs, snapshot["bytes"] / 1024 ** 2))
+    print("CPU {0:.2f}s ({1:.0%} of wall time), peak RSS {2:.1f} MB".format(cpu, cpu / elapsed, rss / 1024))
+    print()
+    print("{0:<20s} {1:>8s} {2:>8s} {3:>9s} {4:>9s} {5:>9s} {6:>9s} {7:>14s}".format(
+        "stage", "items", "errors", "fetch p50", "fetch p99", "item p50", "item p99", "parse+scrape s"))
+
+    def ms(latency, kind, quantile):
+        value = latency.get(kind, {}).get(quantile)
+        return "-" if value is None else "{0:.1f}ms".format(value * 1000)
+
+    for name, stage in snapshot["stages"].items():
+        latency = stage.get("latency", {})
+        # Wall time spent parsing and scraping rather than waiting on the network. CPU time is only measured for the
+        # whole run above, it cannot be told apart by stage.
+        busy = sum(latency.get(kind, {}).get("sum", 0) for kind in ("parse", "scrape"))
+        print("{0:<20s} {1:>8d} {2:>8d} {3:>9s} {4:>9s} {5:>9s} {6:>9s} {7:>14.2f}".format(
+            name, stage["processed"], sum(stage["errors"].values()), ms(latency, "fetch", "p50"),
+            ms(latency, "fetch", "p99"), ms(latency, "item", "p50"), ms(latency, "item", "p99"), busy))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cuisines", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=None, help="workers for every stage")
+    parser.add_argument("--connections", type=int, default=None, help="connections to the mock site")
+    parser.add_argument("--parser", default="inline", choices=["inline", "thread", "process"])
+    parser.add_argument("--incremental", default=None, help="state file of an incremental crawl")
+    parser.add_argument("--port", type=int, default=None, help="port of the mock site, by default a free one")
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    server, host = start_in_process(site_from_arguments(args), port=args.port)
+    try:
+        collector, outputs = Collector(), []
+        pipeline = build(args, host, collector, outputs.append)
+
+        before = cpu_time()
+        started = time.perf_counter()
+        pipeline.run()
+        elapsed = time.perf_counter() - started
+        cpu = cpu_time() - before
+    finally:
+        server.terminate()
+
+    report(collector.snapshot, elapsed, len(outputs), cpu, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Per-item scheduling overhead of a stage: items pass through a few stages whose process() does nothing, so the time
+# per item is the cost of moving it between stages. Compares the worker pools stages run now with the task spawned
+# per item (behind a semaphore) they used before, and passing items one at a time with passing them in chunks:
+#
+#     python -m benchmarks.scheduling [--items 100000] [--stages 3] [--workers 5] [--chunk-size 100]
+
+import argparse
+import asyncio
+import time
+
+from cyborg import Pipeline
+from cyborg.lib import QueueDone, Limit
+from cyborg.scraper import Processor
+
+
+class NoOp(Processor):
+    async def process(self, data, url):
+        return data, url
+
+
+class ChunkedNoOp(NoOp):
+    PROCESS_CHUNKS = True
+
+    async def process_chunk(self, items):
+        return items
+
+
+class SpawnPerItem(NoOp):
+    # How stages scheduled items before: a new task for every item, once a semaphore slot is free
+    async def start(self):
+        limit = Limit(self.size)
+        while True:
+            obj = await self.input_queue.get()
+            if obj is QueueDone:
+                self.input_queue.task_done()
+                await self.input_queue.join()
+                await self.output(QueueDone)
+                return
+            await limit.acquire()
+            asyncio.create_task(self.run_one(obj, limit))
+
+    async def run_one(self, obj, limit):
+        try:
+            await self.run_single(obj)
+        finally:
+            self.input_queue.task_done()
+            limit.release()
+
+
+async def run(handler, items, stages, workers, chunk_size):
+    loop = asyncio.get_running_loop()
+    created = [0]
+
+    def count_tasks(loop, coro, **kwargs):
+        created[0] += 1
+        return asyncio.Task(coro, loop=loop, **kwargs)
+
+    loop.set_task_factory(count_tasks)
+    pipeline = Pipeline().feed(range(items)).defaults(workers=workers, queue_size=100)
+    if chunk_size > 1:
+        pipeline.chunks(chunk_size)
+    for _ in range(stages):
+        pipeline.pipe(handler)
+    outputs = [0]
+    pipeline.output(lambda item: outputs.__setitem__(0, outputs[0] + 1))
+
+    started = time.perf_counter()
+    await pipeline.start()
+    elapsed = time.perf_counter() - started
+    loop.set_task_factory(None)
+
+    assert outputs[0] == items, "{0} of {1} items came out".format(outputs[0], items)
+    return elapsed, created[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=100000)
+    parser.add_argument("--stages", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=5)
+    parser.add_argument("--chunk-size", type=int, default=100)
+    args = parser.parse_args()
+
+    print("{0} items through {1} stages with {2} workers each".format(args.items, args.stages, args.workers))
+    print("{0:<20s} {1:>10s} {2:>14s} {3:>10s}".format("scheduling", "seconds", "us/item/stage", "tasks"))
+    runs = (
+        ("task per item", SpawnPerItem, 1),
+        ("worker pool", NoOp, 1),
+        ("chunks", NoOp, args.chunk_size),
+        ("process_chunk", ChunkedNoOp, args.chunk_size)
+    )
+    for name, handler, chunk_size in runs:
+        elapsed, tasks = asyncio.run(run(handler, args.items, args.stages, args.workers, chunk_size))
+        print("{0:<20s} {1:>10.2f} {2:>14.2f} {3:>10d}".format(
+            name, elapsed, elapsed / (args.items * args.stages) * 1e6, tasks))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
 from .pipeline import Pipeline
 from .scraper import Scraper, BatchProcessor
-from .page import Page
\ No newline at end of file
+from .page import Page
+from .retry import RetryPolicy
+from .extract import Schema, Field, Nested
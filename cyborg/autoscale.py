@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+logger = logging.getLogger("autoscale")
+
+
+class Autoscaler(object):
+    # Periodically moves workers to the stage that is the bottleneck of a pipeline. A stage is a bottleneck when
+    # its input queue is backing up while its workers are busy (not counting time spent blocked on a full output
+    # queue, which means the bottleneck is further down the pipeline).
+
+    def __init__(self, max_workers=100, min_workers=1, interval=1.0):
+        self.max_workers = max_workers
+        self.min_workers = min_workers
+        self.interval = interval
+        self.last = {}
+
+    def sample(self, handler):
+        service_time = handler.busy_time - handler.blocked_time
+        previous = self.last.get(handler, 0.0)
+        self.last[handler] = service_time
+        return (service_time - previous) / (handler.workers * self.interval)
+
+    async def run(self, handlers):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.rebalance(handlers)
+
+    def rebalance(self, handlers):
+        usage = []
+        for handler in handlers:
+            queue = handler.input_queue
+            depth = queue.qsize() / queue.maxsize if queue.maxsize else 0
+            usage.append((handler, self.sample(handler), depth))
+
+        total = sum(handler.workers for handler in handlers)
+
+        for handler, utilisation, depth in usage:
+            if depth == 0 and utilisation < 0.25 and handler.workers > self.min_workers:
+                handler.set_workers(handler.workers - 1)
+                total -= 1
+
+        busy = [(utilisation * depth, handler) for handler, utilisation, depth in usage
+                if depth >= 0.5 and utilisation >= 0.75]
+        if not busy:
+            return
+
+        _, bottleneck = max(busy, key=lambda pair: pair[0])
+        extra = max(1, bottleneck.workers // 4)
+
+        if total + extra > self.max_workers:
+            # Take workers from the least used stage when we have no budget left
+            donors = [(utilisation, handler) for handler, utilisation, _ in usage
+                      if handler is not bottleneck and handler.workers > self.min_workers]
+            if not donors:
+                return
+            _, donor = min(donors, key=lambda pair: pair[0])
+            extra = min(extra, donor.workers - self.min_workers)
+            donor.set_workers(donor.workers - extra)
+
+        logger.info("Scaling {0} to {1} workers".format(bottleneck.__class__.__name__, bottleneck.workers + extra))
+        bottleneck.set_workers(bottleneck.workers + extra)
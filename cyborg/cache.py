@@ -0,0 +1,173 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from multidict import CIMultiDict
+from .lib import BackgroundThread
+
+logger = logging.getLogger("cache")
+
+
+class CachedResponse(object):
+    # Stands in for the aiohttp response of a page served from the cache
+    body_size = 0
+
+    def __init__(self, url, status, headers):
+        self.url = url
+        self.status = status
+        self.headers = headers
+
+
+class CacheEntry(object):
+    def __init__(self, url, digest, status, headers, etag, last_modified, stored):
+        self.url = url
+        self.digest = digest
+        self.status = status
+        self.headers = CIMultiDict(json.loads(headers))
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = stored
+
+    @property
+    def response(self):
+        return CachedResponse(self.url, self.status, self.headers)
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache(object):
+    # Bodies are stored zlib compressed under their sha256 so identical pages are only stored once. An sqlite index
+    # maps URLs to bodies. All disk access happens on a single background thread.
+
+    def __init__(self, path, ttl=86400, max_size=1024 ** 3, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+
+        self.db = None
+        self.total_size = 0
+        self.thread = BackgroundThread()
+
+    def connect(self):
+        if self.db is not None:
+            return
+
+        os.makedirs(os.path.join(self.path, "objects"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.path, "index.db"), check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY, digest TEXT, status INTEGER, headers TEXT,
+                etag TEXT, last_modified TEXT, stored REAL, accessed REAL
+            );
+            CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER);
+            CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+            CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+        """)
+        self.total_size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def object_path(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    def is_fresh(self, entry):
+        return self.offline or time.time() - entry.stored < self.ttl
+
+    def _lookup(self, url):
+        self.connect()
+        row = self.db.execute("SELECT url, digest, status, headers, etag, last_modified, stored "
+                              "FROM entries WHERE url = ?", (url,)).fetchone()
+        return CacheEntry(*row) if row else None
+
+    def _load(self, entry):
+        self.db.execute("UPDATE entries SET accessed = ? WHERE url = ?", (time.time(), entry.url))
+        self.db.commit()
+        try:
+            with open(self.object_path(entry.digest), "rb") as fd:
+                return zlib.decompress(fd.read()).decode("utf-8")
+        except OSError:
+            logger.warning("Cached body for {0} is missing".format(entry.url))
+            self.db.execute("DELETE FROM entries WHERE url = ?", (entry.url,))
+            self.db.commit()
+            return None
+
+    def _revalidated(self, url):
+        now = time.time()
+        self.db.execute("UPDATE entries SET stored = ?, accessed = ? WHERE url = ?", (now, now, url))
+        self.db.commit()
+
+    def _store(self, url, status, headers, body):
+        self.connect()
+        headers = CIMultiDict(headers)
+        data = body.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+
+        if not self.db.execute("SELECT 1 FROM objects WHERE digest = ?", (digest,)).fetchone():
+            compressed = zlib.compress(data)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as fd:
+                fd.write(compressed)
+            os.replace(path + ".tmp", path)
+            self.db.execute("INSERT INTO objects VALUES (?, ?)", (digest, len(compressed)))
+            self.total_size += len(compressed)
+
+        previous = self.db.execute("SELECT digest FROM entries WHERE url = ?", (url,)).fetchone()
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+            url, digest, status, json.dumps(dict(headers)), headers.get("ETag"), headers.get("Last-Modified"), now, now
+        ))
+        if previous and previous[0] != digest:
+            self.drop_object(previous[0])
+
+        self.evict()
+        self.db.commit()
+
+    def drop_object(self, digest):
+        if self.db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+            return
+        size = self.db.execute("SELECT size FROM objects WHERE digest = ?", (digest,)).fetchone()
+        self.db.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+        self.total_size -= size[0] if size else 0
+        try:
+            os.remove(self.object_path(digest))
+        except OSError:
+            pass
+
+    def evict(self):
+        # Drop the least recently used entries until we are back under max_size
+        while self.total_size > self.max_size:
+            oldest = self.db.execute("SELECT url, digest FROM entries ORDER BY accessed LIMIT 100").fetchall()
+            if not oldest:
+                break
+            for url, digest in oldest:
+                self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+                self.drop_object(digest)
+                if self.total_size <= self.max_size:
+                    break
+
+    async def lookup(self, url):
+        return await self.thread.run(self._lookup, url)
+
+    async def load(self, entry):
+        return await self.thread.run(self._load, entry)
+
+    async def revalidated(self, url):
+        await self.thread.run(self._revalidated, url)
+
+    async def store(self, url, response, body):
+        await self.thread.run(self._store, url, response.status, list(response.headers.items()), body)
+
+    async def close(self):
+        if self.db is not None:
+            await self.thread.run(self.db.close)
+            self.db = None
+        self.thread.shutdown()
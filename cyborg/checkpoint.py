@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import os
+import pickle
+import time
+from .lib import QueueDone, unwrap
+
+logger = logging.getLogger("checkpoint")
+
+
+def queue_items(queue):
+    # Items waiting to be retried start over on resume
+    if hasattr(queue, "pending"):
+        return queue.pending()
+    return [unwrap(item) for item in queue._queue if item is not QueueDone]
+
+
+class Checkpointer(object):
+    # Periodically saves the items waiting in every queue of a pipeline, the items each stage is working on, the
+    # stage state (like the keys seen by unique()) and the number of input items consumed.
+
+    def __init__(self, path, interval=60, resume=False):
+        self.path = path
+        self.interval = interval
+        self.resume = resume
+
+    def snapshot(self, queues, stages, consumed, output_processed, output=(), draining=(), changes=None):
+        # Taken without yielding to the event loop, so every item is in exactly one place. output holds the (data, url)
+        # pairs given to the pipeline's output but not written yet, draining the items taken off the last queue that
+        # have not been given to it, and changes the run of the pipeline's incremental.ChangeTracker.
+        queued = [queue_items(queue) for queue in queues]
+        queued[-1][:0] = draining
+        return pickle.dumps({
+            "time": time.time(),
+            "consumed": consumed,
+            "processed": output_processed,
+            "output": list(output),
+            "queues": queued,
+            "stages": [stage.checkpoint() if hasattr(stage, "checkpoint") else None for stage in stages],
+            "changes": changes
+        })
+
+    def write(self, data):
+        with open(self.path + ".tmp", "wb") as fd:
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    async def save(self, data):
+        await asyncio.get_running_loop().run_in_executor(None, self.write, data)
+        logger.info("Saved checkpoint to {0}".format(self.path))
+
+    def load(self):
+        if not self.resume or not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as fd:
+            state = pickle.load(fd)
+        logger.info("Resuming from checkpoint taken at {0}".format(time.ctime(state["time"])))
+        return state
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def run(self, take_snapshot):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.save(take_snapshot())
@@ -0,0 +1,282 @@
+import asyncio
+import copy
+import logging
+import multiprocessing
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .lib import QueueDone, Chunk, wait_all
+from .processors.dedup import key_digest
+from .sinks import Sink
+from .sources import Source
+
+logger = logging.getLogger("distributed")
+
+
+def shard(key, shards):
+    return int.from_bytes(key_digest(key), "big") % shards
+
+
+def item_data(item):
+    return item[0] if isinstance(item, tuple) else item
+
+
+class Router(Sink):
+    # Sends batches of (data, url) items to one of several multiprocessing queues. With a key function every item
+    # with the same key goes to the same queue, otherwise the key is the whole item. Once finished every queue is
+    # sent QueueDone, so the reader knows this producer is done.
+    WHOLE_ITEMS = True
+
+    def __init__(self, targets, key=None, batch_size=100, flush_interval=0.2):
+        super().__init__(batch_size=batch_size, flush_interval=flush_interval)
+        self.targets = targets
+        self.key = key
+
+    def write(self, items):
+        if len(self.targets) == 1:
+            self.targets[0].put(items)
+            return
+
+        batches = [[] for _ in self.targets]
+        for item in items:
+            key = self.key(item_data(item)) if self.key is not None else item
+            batches[shard(key, len(self.targets))].append(item)
+        for target, batch in zip(self.targets, batches):
+            if batch:
+                target.put(batch)
+
+    def close(self):
+        for target in self.targets:
+            target.put(QueueDone)
+
+
+class QueueSource(Source):
+    # Reads the batches sent by Routers until each of the producers has sent QueueDone
+    def __init__(self, queue, producers):
+        super().__init__()
+        self.queue = queue
+        self.producers = producers
+
+    async def next_batch(self):
+        while self.producers:
+            batch = await self.run(self.queue.get)
+            if batch is QueueDone:
+                self.producers -= 1
+                continue
+            self.items_read += len(batch)
+            return batch
+        return None
+
+
+class Distributor(object):
+    # Runs a pipeline in several worker processes, each with its own event loop and Requester. The pipeline is
+    # cut into segments before every unique() stage. Items entering a segment are sent to the worker chosen by a
+    # hash of the segment's unique key, so each key is only ever checked by one worker and deduplication stays
+    # exact. The first segment is sharded by a hash of the input items. Outputs are sent back to the parent,
+    # which writes them with the pipeline's output, and per-stage counters from all workers are added up.
+
+    def __init__(self, pipeline, workers, queue_size=100, stats_interval=1.0):
+        self.pipeline = pipeline
+        self.workers = workers
+        self.queue_size = queue_size
+        self.stats_interval = stats_interval
+
+        # The segments are only cut when the pipeline runs, so stages piped after distribute() are included
+        self.bounds = []
+        self.keys = []
+
+        self.context = multiprocessing.get_context("fork")
+        self.queues = None
+        self.results = None
+        self.stats = None
+        # Per stage totals over all workers, indexed like pipeline.processes
+        self.totals = []
+
+    def cut(self):
+        processes = self.pipeline.processes
+        if not processes:
+            raise RuntimeError("A distributed pipeline needs at least one stage")
+        cuts = [idx for idx, process in enumerate(processes) if idx > 0 and hasattr(process, "DEDUP_KEY")]
+        self.bounds = list(zip([0] + cuts, cuts + [len(processes)]))
+        self.keys = [getattr(processes[start], "DEDUP_KEY", None) for start, _ in self.bounds]
+        self.totals = [{"processed": 0, "errors": {}, "stats": {}} for _ in processes]
+
+    def segment(self, index, worker):
+        start, end = self.bounds[index]
+        pipeline = self.pipeline
+        segment = copy.copy(pipeline)
+        segment.processes = pipeline.processes[start:end]
+        segment.stage_options = pipeline.stage_options[start:end]
+        segment.plugins, segment.exporters = [], []
+        segment.checkpointer = segment.distributor = segment.tracer = segment.changes = None
+        segment.autoscaler = copy.copy(pipeline.autoscaler)
+        segment.consumed = segment.processed = 0
+        segment.feed(QueueSource(self.queues[index][worker], 1 if index == 0 else self.workers))
+
+        if index + 1 < len(self.bounds):
+            segment.output(Router(self.queues[index + 1], self.keys[index + 1]))
+        else:
+            segment.output(Router([self.results]))
+        return segment
+
+    def worker_main(self, worker):
+        asyncio.run(self.run_worker(worker))
+
+    async def run_worker(self, worker):
+        requester = self.pipeline.make_requester()
+        segments = [self.segment(index, worker) for index in range(len(self.bounds))]
+        for segment in segments:
+            segment.requester = requester
+
+        reporter = asyncio.create_task(self.report(worker, segments))
+        tasks = [asyncio.create_task(segment.start()) for segment in segments]
+        try:
+            # Raises if a segment failed, so the worker exits with an error the parent notices
+            await wait_all(tasks)
+        finally:
+            reporter.cancel()
+            self.stats.put((worker, True, self.snapshot(segments)))
+            await requester.close()
+
+    def snapshot(self, segments):
+        stages = []
+        for segment in segments:
+            for stage in getattr(segment, "stages", []):
+                stages.append({
+                    "processed": stage.processed,
+                    "errors": dict(stage.errors),
+                    "stats": dict(getattr(stage, "stats", {}))
+                })
+        return stages
+
+    async def report(self, worker, segments):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self.stats.put((worker, False, self.snapshot(segments)))
+
+    def aggregate(self, snapshots):
+        totals = [{"processed": 0, "errors": {}, "stats": {}} for _ in self.pipeline.processes]
+        for snapshot in snapshots.values():
+            for total, stage in zip(totals, snapshot):
+                total["processed"] += stage["processed"]
+                for kind in ("errors", "stats"):
+                    for key, value in stage[kind].items():
+                        total[kind][key] = total[kind].get(key, 0) + value
+        for total in totals:
+            # Rates are averaged over the workers, everything else is summed
+            for key in total["stats"]:
+                if key.endswith("_rate"):
+                    total["stats"][key] /= max(len(snapshots), 1)
+        self.totals = totals
+
+    def display(self):
+        counts = {}
+        for process, total in zip(self.pipeline.processes, self.totals):
+            name = getattr(process, "__name__", process.__class__.__name__)
+            counts[name] = counts.get(name, 0) + 1
+            if counts[name] > 1:
+                name = "{0}#{1}".format(name, counts[name])
+            print("{0:<20s}: {1:>6d}: {2} {3}".format(name, total["processed"],
+                                                      {k: v for k, v in total["errors"].items() if v},
+                                                      {k: round(v, 2) for k, v in total["stats"].items() if v}))
+        print(" ")
+
+    async def run(self, start):
+        self.cut()
+        self.queues = [[self.context.Queue(self.queue_size) for _ in range(self.workers)] for _ in self.bounds]
+        self.results = self.context.Queue(self.queue_size)
+        self.stats = self.context.Queue()
+
+        # Not daemons, so workers can start their own parser processes
+        workers = [self.context.Process(target=self.worker_main, args=(worker,)) for worker in range(self.workers)]
+        for process in workers:
+            process.start()
+        logger.info("Started {0} workers for {1} segments".format(self.workers, len(self.bounds)))
+
+        # Blocking reads of the result and stats queues each get their own thread
+        executor = ThreadPoolExecutor(2)
+        exit_queue = asyncio.Queue(self.queue_size)
+        tasks = [
+            asyncio.create_task(self.feed()),
+            asyncio.create_task(self.collect(exit_queue, workers, executor)),
+            asyncio.create_task(self.collect_stats(workers, executor)),
+            asyncio.create_task(self.pipeline._drain(exit_queue, start))
+        ]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        except BaseException:
+            for process in workers:
+                process.terminate()
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for process in workers:
+                process.join(1)
+            executor.shutdown(wait=False)
+
+        errors = {}
+        for total in self.totals:
+            for key, value in total["errors"].items():
+                errors[key] = errors.get(key, 0) + value
+        self.pipeline.errors = errors
+
+    async def feed(self):
+        router = Router(self.queues[0], self.keys[0])
+        await router.start()
+        source = self.pipeline.input
+        if isinstance(source, Source):
+            await source.open()
+            try:
+                while True:
+                    batch = await source.next_batch()
+                    if batch is None:
+                        break
+                    for item in batch:
+                        await router.put(item)
+            finally:
+                await source.close()
+        else:
+            for item in source:
+                await router.put(item)
+        await router.finish()
+
+    async def collect(self, exit_queue, workers, executor):
+        loop = asyncio.get_running_loop()
+        done = 0
+        while done < self.workers:
+            try:
+                batch = await loop.run_in_executor(executor, self.results.get, True, 1)
+            except queue.Empty:
+                self.check(workers)
+                continue
+            if batch is QueueDone:
+                done += 1
+                continue
+            await exit_queue.put(Chunk(batch))
+        await exit_queue.put(QueueDone)
+
+    async def collect_stats(self, workers, executor):
+        loop = asyncio.get_running_loop()
+        snapshots, finished, last_display = {}, set(), time.time()
+        while len(finished) < self.workers:
+            try:
+                worker, final, snapshot = await loop.run_in_executor(executor, self.stats.get, True, 1)
+            except queue.Empty:
+                self.check(workers)
+                continue
+            snapshots[worker] = snapshot
+            if final:
+                finished.add(worker)
+            self.aggregate(snapshots)
+            if "display" in self.pipeline.plugins and time.time() - last_display >= 1:
+                self.display()
+                last_display = time.time()
+
+    def check(self, workers):
+        for idx, process in enumerate(workers):
+            if process.exitcode not in (None, 0):
+                raise RuntimeError("Worker {0} exited with code {1}".format(idx, process.exitcode))
@@ -0,0 +1,154 @@
+import re
+from lxml import etree
+from .selector.selector import xpath, SelectorException
+
+REQUIRED = object()
+
+
+def trim_whitespace(text):
+    return re.sub(r"\s+", " ", text)
+
+
+def strip(text):
+    return text.strip()
+
+
+def compile_xpath(expression):
+    return etree.XPath(expression, smart_strings=False)
+
+
+def node_path(selector):
+    # None selects the node itself, so attributes of a record's root element can be read
+    return "self::*" if selector is None else xpath(selector)
+
+
+class Field(object):
+    # The text of the first element matching selector, or the value of its attribute attr. With many=True a list
+    # for every match. normalize is a function, or a list of functions applied in order, for example
+    # [trim_whitespace, strip] or int. A field without a default raises SelectorException when nothing matches.
+
+    def __init__(self, selector=None, attr=None, normalize=None, default=REQUIRED, many=False):
+        self.selector = selector
+        self.attr = attr
+        self.many = many
+        self.default = default
+        if normalize is None:
+            self.normalize = ()
+        elif callable(normalize):
+            self.normalize = (normalize,)
+        else:
+            self.normalize = tuple(normalize)
+
+        path = node_path(selector)
+        if many:
+            self.values = compile_xpath(path if attr is None else "({0})/@{1}".format(path, attr))
+        else:
+            # string() hands back the text or attribute directly, so no element objects are created for the match
+            target = "({0})[1]".format(path) if attr is None else "(({0})/@{1})[1]".format(path, attr)
+            self.value = compile_xpath("string({0})".format(target))
+            self.exists = compile_xpath("boolean({0})".format(target))
+
+    def clean(self, value):
+        for func in self.normalize:
+            value = func(value)
+        return value
+
+    def extract(self, node):
+        if self.many:
+            values = self.values(node)
+            if self.attr is None:
+                values = [match.text_content() for match in values]
+            return [self.clean(value) for value in values]
+
+        value = self.value(node)
+        if value or self.exists(node):
+            return self.clean(value)
+        return self.missing()
+
+    def missing(self):
+        if self.default is REQUIRED:
+            raise SelectorException(self.selector)
+        return self.default
+
+
+class SharedMatch(object):
+    # Attribute fields with the same selector, read from the element found by a single query
+
+    def __init__(self, selector, fields):
+        self.first = compile_xpath("({0})[1]".format(node_path(selector)))
+        self.fields = fields
+
+    def extract_into(self, record, node):
+        matches = self.first(node)
+        for name, field in self.fields:
+            value = matches[0].get(field.attr) if matches else None
+            record[name] = field.missing() if value is None else field.clean(value)
+
+
+class Nested(object):
+    # A record built from fields for every element matching selector, relative to that element.
+    # With many=False only the first match, or default when there is none.
+
+    def __init__(self, selector, fields, many=True, default=None):
+        self.selector = selector
+        self.many = many
+        self.default = default
+        self.record = Record(fields)
+        self.matches = compile_xpath(node_path(selector) if many else "({0})[1]".format(node_path(selector)))
+
+    def extract(self, node):
+        records = [self.record.extract(match) for match in self.matches(node)]
+        if self.many:
+            return records
+        return records[0] if records else self.default
+
+
+class Record(object):
+    # The fields of a record, compiled once. Attribute fields sharing a selector are read together.
+
+    def __init__(self, fields):
+        # A plain string is the selector of a text field
+        fields = [(name, Field(spec) if isinstance(spec, str) else spec) for name, spec in fields.items()]
+        self.names = [name for name, _ in fields]
+
+        shared = {}
+        for name, field in fields:
+            if isinstance(field, Field) and field.attr is not None and not field.many:
+                shared.setdefault(field.selector, []).append((name, field))
+        shared = {selector: group for selector, group in shared.items() if len(group) > 1}
+
+        self.fields = [(name, field) for name, field in fields
+                       if not any((name, field) in group for group in shared.values())]
+        self.shared = [SharedMatch(selector, group) for selector, group in shared.items()]
+
+    def extract(self, node):
+        if not self.shared:
+            return {name: field.extract(node) for name, field in self.fields}
+        record = dict.fromkeys(self.names)
+        for name, field in self.fields:
+            record[name] = field.extract(node)
+        for group in self.shared:
+            group.extract_into(record, node)
+        return record
+
+
+class Schema(object):
+    # Declares what a Scraper extracts from a page. Each element matching root becomes a record (the whole page
+    # when root is None), and url is the Field holding the URL passed on with it. Every selector is compiled to an
+    # XPath when the schema is created, so a schema set on a Scraper class is compiled once for that class.
+
+    URL = "__url__"
+
+    def __init__(self, fields, root=None, url=None):
+        fields = dict(fields)
+        if url is not None:
+            # Read along with the other fields, so it can share their query
+            fields[self.URL] = Field(url) if isinstance(url, str) else url
+        self.record = Record(fields)
+        self.root = None if root is None else compile_xpath(xpath(root))
+
+    def extract(self, document):
+        nodes = [document] if self.root is None else self.root(document)
+        for node in nodes:
+            record = self.record.extract(node)
+            yield record, record.pop(self.URL, None)
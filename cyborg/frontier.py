@@ -0,0 +1,165 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import sqlite3
+import tempfile
+import urllib.parse
+from collections import deque
+from .lib import QueueDone, Chunk, unwrap
+
+logger = logging.getLogger("frontier")
+
+
+def url_host(item):
+    url = item[1] if isinstance(item, tuple) else item
+    return urllib.parse.urlsplit(url).netloc if isinstance(url, str) else ""
+
+
+class FrontierQueue(asyncio.Queue):
+    # A stage's input queue that hands out items by priority and takes hosts in turn, so a burst of links to one
+    # host does not hold up the others. priority is a function of an item giving a number or string, lower values
+    # first, and applies between the items of a host. host is a function giving an item's host, by default the host
+    # of its URL (relative URLs share the host ""). Past memory_size items new items are spilled to a sqlite file in
+    # spill_dir, and read back in priority order as the queue drains, so putting an item never blocks. get(),
+    # task_done(), join() and QueueDone work as with any other stage queue.
+
+    def __init__(self, memory_size=10000, priority=None, host=None, spill_dir=None, spill_batch=1000):
+        self.memory_size = memory_size
+        self.priority = priority
+        self.host = host or url_host
+        self.spill_dir = spill_dir
+        self.spill_batch = spill_batch
+        super().__init__(memory_size)
+
+    def _init(self, maxsize):
+        # Heaps of (priority, sequence, item) by host, and the hosts with items in memory in the order they are served
+        self.hosts = {}
+        self.ring = deque()
+        self.in_memory = 0
+        self.sequence = itertools.count()
+        self.done = False
+
+        self.db = None
+        self.db_path = None
+        self.spilled = 0
+        self.spill_buffer = []
+
+    def qsize(self):
+        return self.in_memory + self.spilled + len(self.spill_buffer) + (1 if self.done else 0)
+
+    def empty(self):
+        return not self.qsize()
+
+    def full(self):
+        # Items past memory_size go to disk instead
+        return False
+
+    def put_nowait(self, item):
+        # The items of a chunk are queued one by one, so each is ordered by its host and priority
+        if isinstance(item, Chunk):
+            for obj in item:
+                super().put_nowait(obj)
+        else:
+            super().put_nowait(item)
+
+    def _put(self, item):
+        if item is QueueDone:
+            self.done = True
+            return
+
+        priority = self.priority(unwrap(item)) if self.priority is not None else 0
+        # Spilled items are ordered by sqlite, which only compares scalars the way Python does
+        if not isinstance(priority, (int, float, str, bytes)):
+            raise TypeError("Frontier priority must be a number or string, not {0!r}".format(priority))
+        entry = (priority, next(self.sequence), item)
+        if self.in_memory < self.memory_size:
+            self.push(entry)
+            return
+
+        self.spill_buffer.append((entry[0], entry[1], pickle.dumps(item, pickle.HIGHEST_PROTOCOL)))
+        if len(self.spill_buffer) >= self.spill_batch:
+            self.write_spilled()
+
+    def _get(self):
+        if not self.in_memory:
+            self.refill()
+        if not self.in_memory:
+            # Only called with items left, so everything before QueueDone has been handed out
+            self.done = False
+            self.close()
+            return QueueDone
+
+        host = self.ring.popleft()
+        heap = self.hosts[host]
+        _, _, item = heapq.heappop(heap)
+        if heap:
+            self.ring.append(host)
+        else:
+            del self.hosts[host]
+        self.in_memory -= 1
+
+        if self.in_memory < self.memory_size // 2:
+            self.refill()
+        return item
+
+    def push(self, entry):
+        host = self.host(unwrap(entry[2]))
+        heap = self.hosts.get(host)
+        if heap is None:
+            heap = self.hosts[host] = []
+            self.ring.append(host)
+        heapq.heappush(heap, entry)
+        self.in_memory += 1
+
+    def open_spill(self):
+        fd, self.db_path = tempfile.mkstemp(suffix=".frontier", dir=self.spill_dir)
+        os.close(fd)
+        logger.info("Frontier is over {0} items, spilling to {1}".format(self.memory_size, self.db_path))
+        # A scratch file that is removed once the queue is drained, so it does not need to survive a crash
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE frontier (priority, sequence INTEGER, item BLOB, "
+                        "PRIMARY KEY (priority, sequence)) WITHOUT ROWID")
+
+    def write_spilled(self):
+        if not self.spill_buffer:
+            return
+        if self.db is None:
+            self.open_spill()
+        self.db.executemany("INSERT INTO frontier VALUES (?, ?, ?)", self.spill_buffer)
+        self.spilled += len(self.spill_buffer)
+        self.spill_buffer = []
+
+    def refill(self):
+        self.write_spilled()
+        if not self.spilled:
+            return
+        rows = self.db.execute("SELECT priority, sequence, item FROM frontier ORDER BY priority, sequence LIMIT ?",
+                               (self.memory_size - self.in_memory,)).fetchall()
+        self.db.executemany("DELETE FROM frontier WHERE priority = ? AND sequence = ?",
+                            [(priority, sequence) for priority, sequence, _ in rows])
+        self.spilled -= len(rows)
+        for priority, sequence, item in rows:
+            self.push((priority, sequence, pickle.loads(item)))
+
+    def pending(self):
+        # Every item waiting, for checkpoints
+        entries = [entry for heap in self.hosts.values() for entry in heap]
+        entries.extend((priority, sequence, pickle.loads(item)) for priority, sequence, item in self.spill_buffer)
+        if self.spilled:
+            entries.extend((priority, sequence, pickle.loads(item)) for priority, sequence, item
+                           in self.db.execute("SELECT priority, sequence, item FROM frontier"))
+        return [unwrap(item) for _, _, item in sorted(entries, key=lambda entry: entry[:2])]
+
+    def disk_usage(self):
+        return os.path.getsize(self.db_path) if self.db_path is not None else 0
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            os.remove(self.db_path)
+            self.db = self.db_path = None
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import logging
+import operator
+import sqlite3
+import time
+from collections import defaultdict
+from .lib import BackgroundThread
+
+logger = logging.getLogger("incremental")
+
+
+def fingerprint(data):
+    return hashlib.blake2b(json.dumps(data, sort_keys=True, default=repr).encode("utf-8"), digest_size=16).digest()
+
+
+def batches(items, size=500):
+    # Keeps queries under sqlite's limit on the number of parameters
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class ChangeTracker(object):
+    # Remembers what a pipeline saw on its previous run, so the next one only outputs what changed. Every record
+    # output is stored with a fingerprint under its key, by default the key of the last unique() stage, and is passed
+    # on as a new or changed record only when its fingerprint differs. Records of the previous run that were not seen
+    # again are output as deleted once the pipeline completes, unless an item failed for good during the run: what it
+    # would have led to may still exist, so deletions are held back until a run without failures. Without a key
+    # records are identified by their fingerprint, so a change shows up as a deleted and a new record.
+    #
+    # Scrapers with SKIP_UNCHANGED set also store a digest of every page along with the keys of the records scraped
+    # from it. A page with the same digest on the next run is neither parsed nor scraped and its records count as
+    # seen. The database is used from a single background thread and writes are buffered into batches. The state is
+    # committed when a run completes and with every pipeline checkpoint, a resumed pipeline carries on with the run of
+    # its checkpoint. An interrupted run otherwise leaves the previous one in place.
+    WRITE_BATCH = 1000
+
+    def __init__(self, path, key=None):
+        self.path = path
+        self.key = operator.itemgetter(key) if isinstance(key, str) else key
+        self.db = None
+        self.thread = BackgroundThread()
+        self.run = None
+        self.counts = defaultdict(int)
+        # Items that failed for good during the run
+        self.failures = 0
+        # Writes not handed to the background thread yet: fingerprints of records by key, pages by URL and the keys
+        # of records counted as seen. Writes handed over run in order before any later query.
+        self.records = {}
+        self.pages = {}
+        self.kept = set()
+        self.writes = []
+
+    @property
+    def running(self):
+        return self.db is not None
+
+    async def open(self, default_key=None):
+        if self.key is None:
+            self.key = default_key
+        self.run = await self.thread.run(self.connect)
+        self.counts.clear()
+        self.failures = 0
+        logger.info("Incremental run {0} using {1}".format(self.run, self.path))
+
+    def connect(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, digest BLOB, keys TEXT, run INTEGER) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, fingerprint BLOB, run INTEGER) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY, started REAL, finished REAL);
+        """)
+        run = self.db.execute("SELECT COALESCE(MAX(run), 0) FROM runs").fetchone()[0] + 1
+        self.db.execute("INSERT INTO runs VALUES (?, ?, NULL)", (run, time.time()))
+        self.db.commit()
+        return run
+
+    async def resume(self, run):
+        # Carries on with the run of a pipeline checkpoint, everything it had compared was committed with it
+        logger.info("Resuming incremental run {0}".format(run))
+        started, self.run = self.run, run
+        await self.thread.run(self.forget_run, started)
+
+    def forget_run(self, run):
+        self.db.execute("DELETE FROM runs WHERE run = ?", (run,))
+        self.db.commit()
+
+    async def close(self):
+        # Anything not committed belongs to a run that did not complete
+        self.records, self.pages, self.kept, self.writes = {}, {}, set(), []
+        await self.thread.run(self.disconnect)
+        self.thread.shutdown()
+
+    def disconnect(self):
+        self.db.rollback()
+        self.db.close()
+        self.db = None
+
+    def record_key(self, data):
+        key = self.key(data) if self.key is not None else fingerprint(data).hex()
+        return key, json.dumps(key, sort_keys=True, default=repr)
+
+    def page_digest(self, content):
+        if content is None:
+            return None
+        return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+    def item_failed(self):
+        self.failures += 1
+
+    async def skip_page(self, url, digest):
+        # A page is skipped when it has not changed and every record scraped from it last time was output
+        if digest is None:
+            return False
+        page = await self.stored_page(url)
+        if page is None or page[0] != digest:
+            return False
+        return await self.keep(url, page)
+
+    async def keep_page(self, url):
+        # Counts the records scraped from a page on the previous run as seen, returns False if any was not output
+        page = await self.stored_page(url)
+        if page is None:
+            return False
+        return await self.keep(url, page)
+
+    async def stored_page(self, url):
+        if url in self.pages:
+            return self.pages[url]
+        return await self.thread.run(self.read_page, url)
+
+    def read_page(self, url):
+        return self.db.execute("SELECT digest, keys FROM pages WHERE url = ?", (url,)).fetchone()
+
+    async def keep(self, url, page):
+        keys = json.loads(page[1])
+        # Records compared during this run are already seen
+        compared = {key for key in keys if key in self.records}
+        stored = [key for key in keys if key not in compared]
+        found = await self.thread.run(self.existing_keys, stored) if stored else set()
+        self.kept.update(found)
+        self.pages[url] = tuple(page)
+        self.write_later()
+        return len(found) + len(compared) == len(set(keys))
+
+    def existing_keys(self, keys):
+        found = set()
+        for batch in batches(keys):
+            found.update(key for key, in self.db.execute(
+                "SELECT key FROM records WHERE key IN ({0})".format(",".join("?" * len(batch))), batch))
+        return found
+
+    def record_page(self, url, digest, records):
+        try:
+            keys = [self.record_key(data)[1] for data in records]
+        except Exception:
+            # Without the keys of its records the page cannot be skipped next time
+            digest, keys = None, []
+        self.pages[url] = (digest, json.dumps(keys))
+        self.write_later()
+
+    async def compare(self, records):
+        # Returns the change to output for each record, or None when it is unchanged
+        keys = [self.record_key(data) for data in records]
+        stored = [stored_key for _, stored_key in keys if stored_key not in self.records]
+        previous = await self.thread.run(self.read_fingerprints, stored) if stored else {}
+
+        changes = []
+        for data, (key, stored_key) in zip(records, keys):
+            new = fingerprint(data)
+            old = self.records[stored_key] if stored_key in self.records else previous.get(stored_key)
+            self.records[stored_key] = new
+            if old is None:
+                change = "new"
+            elif old != new:
+                change = "changed"
+            else:
+                self.counts["unchanged"] += 1
+                changes.append(None)
+                continue
+            self.counts[change] += 1
+            changes.append({"change": change, "key": key, "record": data})
+        self.write_later()
+        return changes
+
+    def read_fingerprints(self, keys):
+        found = {}
+        for batch in batches(keys):
+            found.update(self.db.execute(
+                "SELECT key, fingerprint FROM records WHERE key IN ({0})".format(",".join("?" * len(batch))), batch))
+        return found
+
+    def write_later(self):
+        if len(self.records) + len(self.pages) + len(self.kept) >= self.WRITE_BATCH:
+            self.writes.append(self.thread.submit(self.write, *self.take_writes()))
+
+    def take_writes(self):
+        writes = self.records, self.pages, self.kept
+        self.records, self.pages, self.kept = {}, {}, set()
+        return writes
+
+    def write(self, records, pages, kept):
+        self.db.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?)",
+                            [(key, value, self.run) for key, value in records.items()])
+        self.db.executemany("UPDATE records SET run = ? WHERE key = ?", [(self.run, key) for key in kept])
+        self.db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                            [(url, digest, keys, self.run) for url, (digest, keys) in pages.items()])
+
+    def write_commit(self, records, pages, kept, finished=None):
+        self.write(records, pages, kept)
+        if finished is not None:
+            self.db.execute("UPDATE runs SET finished = ? WHERE run = ?", (finished, self.run))
+        self.db.commit()
+
+    def written(self):
+        # Raises the error of a failed write, the commit after it would leave out its records
+        writes, self.writes = self.writes, []
+        for write in writes:
+            write.result()
+
+    def checkpoint(self):
+        # Called while a pipeline checkpoint is taken, which does not yield to the event loop. The records compared
+        # so far are committed before the checkpoint is saved, so the two agree.
+        self.thread.submit(self.write_commit, *self.take_writes()).result()
+        self.written()
+        return self.run
+
+    async def deletions(self):
+        # Records of earlier runs that were not seen in this one
+        if self.failures:
+            logger.warning("{0} items failed, records not seen in this run are not reported as deleted".format(
+                self.failures))
+            return []
+        self.writes.append(self.thread.submit(self.write, *self.take_writes()))
+        keys = await self.thread.run(self.delete_unseen)
+        deleted = [{"change": "deleted", "key": json.loads(key), "record": None} for key in keys]
+        self.counts["deleted"] = len(deleted)
+        return deleted
+
+    def delete_unseen(self):
+        keys = [key for key, in self.db.execute("SELECT key FROM records WHERE run < ?", (self.run,))]
+        self.db.execute("DELETE FROM records WHERE run < ?", (self.run,))
+        self.db.execute("DELETE FROM pages WHERE run < ?", (self.run,))
+        return keys
+
+    async def commit(self):
+        await self.thread.run(self.write_commit, *self.take_writes(), time.time())
+        self.written()
+        logger.info("Run {0}: {1} new, {2} changed, {3} deleted and {4} unchanged records".format(
+            self.run, self.counts["new"], self.counts["changed"], self.counts["deleted"], self.counts["unchanged"]))
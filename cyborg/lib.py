@@ -1,6 +1,119 @@
 from asyncio import Queue
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import collections
+import itertools
 
 
 class QueueDone(object):
     def __init__(self):
-        raise RuntimeError("Cannot create instance of QueueDone")
\ No newline at end of file
+        raise RuntimeError("Cannot create instance of QueueDone")
+
+
+class Chunk(list):
+    # Several items moved between stages as one queue entry, see Pipeline.chunks(). A queue holding chunks counts
+    # each chunk as one entry.
+    __slots__ = ()
+
+
+class Retry(object):
+    # An item put back on a stage's input queue to be retried, along with the key of its attempt in the stage's
+    # retrying dict. Equal items can be the same object, so the item alone does not say which attempt it is.
+    __slots__ = ("item", "key")
+
+    def __init__(self, item, key):
+        self.item = item
+        self.key = key
+
+
+def unwrap(item):
+    return item.item if isinstance(item, Retry) else item
+
+
+def chunked(items, size):
+    # Groups items into Chunks of up to size items, or yields them one at a time when size is 1
+    if size <= 1:
+        yield from items
+        return
+    items = iter(items)
+    while True:
+        chunk = Chunk(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BackgroundThread(object):
+    # A single thread that blocking work such as disk access is handed to, so it runs in order off the event loop.
+    # The thread is started on first use and again after shutdown(), so its owner can be used for several runs.
+
+    def __init__(self):
+        self.executor = None
+
+    @property
+    def started(self):
+        return self.executor is not None
+
+    def submit(self, func, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(1)
+        return self.executor.submit(func, *args)
+
+    async def run(self, func, *args):
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def shutdown(self, wait=False):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+
+class Limit(object):
+    # A semaphore that can be resized while tasks are waiting on it
+
+    def __init__(self, size):
+        self.size = size
+        self.active = 0
+        self.waiters = collections.deque()
+
+    async def acquire(self):
+        while self.active >= self.size:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # We were woken up but will not use the slot, hand it to the next waiter
+                    self.wake()
+                raise
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def resize(self, size):
+        self.size = max(1, size)
+        self.wake()
+
+    def wake(self):
+        free = self.size - self.active
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+async def wait_all(tasks):
+    # Waits for tasks like a task group: the first one to fail cancels the others, and its exception is raised once
+    # they have stopped. Cancelling the caller cancels every task.
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,218 @@
+import asyncio
+import bisect
+import json
+import logging
+import time
+
+logger = logging.getLogger("metrics")
+
+
+class Histogram(object):
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value, count=1):
+        self.counts[bisect.bisect_left(self.buckets, value)] += count
+        self.count += count
+        self.sum += value * count
+
+    def quantile(self, q):
+        # Estimated by interpolating inside the bucket holding the quantile
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for idx, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[idx - 1] if idx > 0 else 0.0
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99)
+        }
+
+
+class PipelineMetrics(object):
+    # Reads the counters kept by the stages of a running pipeline when a snapshot is taken, so collecting
+    # metrics costs nothing on the hot path.
+
+    def __init__(self, pipeline, stages, requester):
+        self.pipeline = pipeline
+        self.stages = stages
+        self.requester = requester
+        self.started = time.time()
+
+        counts = {}
+        self.names = []
+        for stage in stages:
+            name = stage.__class__.__name__
+            counts[name] = counts.get(name, 0) + 1
+            self.names.append(name if counts[name] == 1 else "{0}#{1}".format(name, counts[name]))
+
+    def stage_snapshot(self, stage):
+        snapshot = {
+            "processed": stage.processed,
+            "errors": {str(k): v for k, v in stage.errors.items() if v},
+            "stats": {k: v for k, v in getattr(stage, "stats", {}).items() if v}
+        }
+        queue = getattr(stage, "input_queue", None)
+        if queue is not None:
+            snapshot["queue_depth"] = queue.qsize()
+            snapshot["queue_size"] = queue.maxsize
+        if hasattr(stage, "histograms"):
+            snapshot.update({
+                "completed": stage.completed,
+                "in_flight": len(stage.in_flight),
+                "workers": stage.workers,
+                "bytes": stage.bytes_received,
+                "latency": {name: histogram.summary() for name, histogram in stage.histograms.items()}
+            })
+        return snapshot
+
+    def input_progress(self):
+        progress = {"consumed": self.pipeline.consumed}
+        if hasattr(self.pipeline.input, "progress"):
+            progress.update(self.pipeline.input.progress())
+        return progress
+
+    def snapshot(self):
+        return {
+            "time": time.time(),
+            "elapsed": time.time() - self.started,
+            "input": self.input_progress(),
+            "output": self.pipeline.processed,
+            "requests": self.requester.requests,
+            "bytes": self.requester.bytes_downloaded,
+            "stages": {name: self.stage_snapshot(stage) for name, stage in zip(self.names, self.stages)}
+        }
+
+    def prometheus(self):
+        lines = []
+
+        def sample(metric, labels, value):
+            label_text = ",".join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels)
+            lines.append("cyborg_{0}{1} {2}".format(metric, "{" + label_text + "}" if labels else "", value))
+
+        def add(metric, kind, samples):
+            lines.append("# TYPE cyborg_{0} {1}".format(metric, kind))
+            for labels, value in samples:
+                sample(metric, labels, value)
+
+        add("input_consumed_total", "counter", [((), self.pipeline.consumed)])
+        if "fraction" in self.input_progress():
+            add("input_progress", "gauge", [((), self.input_progress()["fraction"])])
+        add("output_total", "counter", [((), self.pipeline.processed)])
+        add("requests_total", "counter", [((), self.requester.requests)])
+        add("downloaded_bytes_total", "counter", [((), self.requester.bytes_downloaded)])
+
+        stages = list(zip(self.names, self.stages))
+        add("processed_total", "counter", [((("stage", n),), s.processed) for n, s in stages])
+        add("errors_total", "counter", [((("stage", n), ("kind", k)), v)
+                                        for n, s in stages for k, v in s.errors.items() if v])
+        add("stage_stat", "gauge", [((("stage", n), ("name", k)), v)
+                                    for n, s in stages for k, v in getattr(s, "stats", {}).items()])
+        add("queue_depth", "gauge", [((("stage", n),), s.input_queue.qsize())
+                                     for n, s in stages if getattr(s, "input_queue", None) is not None])
+
+        handlers = [(n, s) for n, s in stages if hasattr(s, "histograms")]
+        add("in_flight", "gauge", [((("stage", n),), len(s.in_flight)) for n, s in handlers])
+        add("workers", "gauge", [((("stage", n),), s.workers) for n, s in handlers])
+
+        for kind in sorted({kind for _, s in handlers for kind in s.histograms}):
+            metric = "{0}_seconds".format(kind)
+            lines.append("# TYPE cyborg_{0} histogram".format(metric))
+            for n, s in handlers:
+                histogram = s.histograms.get(kind)
+                if histogram is None:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    sample(metric + "_bucket", (("stage", n), ("le", bound)), cumulative)
+                sample(metric + "_sum", (("stage", n),), histogram.sum)
+                sample(metric + "_count", (("stage", n),), histogram.count)
+
+        return "\n".join(lines) + "\n"
+
+
+class Exporter(object):
+    async def run(self, metrics):
+        raise NotImplementedError()
+
+    def close(self, metrics):
+        # Called once the pipeline has finished or failed
+        return
+
+
+class DisplayExporter(Exporter):
+    # The "display" plugin: prints the progress and errors of every stage
+    def __init__(self, interval=1):
+        self.interval = interval
+
+    async def run(self, metrics):
+        while True:
+            await asyncio.sleep(self.interval)
+            snapshot = metrics.snapshot()
+            if "fraction" in snapshot["input"]:
+                print("{0:<20s}: {1:>6d}: {2:.1%}".format("Input", snapshot["input"]["consumed"],
+                                                          snapshot["input"]["fraction"]))
+            for name, stage in snapshot["stages"].items():
+                print("{0:<20s}: {1:>6d}: {2} {3}".format(name, stage["processed"], stage["errors"],
+                                                          {k: round(v, 2) for k, v in stage["stats"].items()}))
+            print(" ")
+
+
+class JsonLinesExporter(Exporter):
+    def __init__(self, path, interval=10):
+        self.path = path
+        self.interval = interval
+
+    def write(self, snapshot):
+        with open(self.path, "a") as fd:
+            fd.write(json.dumps(snapshot) + "\n")
+
+    async def run(self, metrics):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.write(metrics.snapshot())
+
+    def close(self, metrics):
+        self.write(metrics.snapshot())
+
+
+class PrometheusExporter(Exporter):
+    # Serves the metrics in the Prometheus text format on every request to host:port
+    def __init__(self, port=9100, host="127.0.0.1"):
+        self.port = port
+        self.host = host
+
+    async def run(self, metrics):
+        async def handle(reader, writer):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = metrics.prometheus().encode("utf-8")
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                             b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+                await writer.drain()
+            except Exception:
+                logger.exception("Could not serve metrics")
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, self.host, self.port)
+        logger.info("Serving metrics on http://{0}:{1}/".format(self.host, self.port))
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            server.close()
@@ -1,9 +1,24 @@
 from .requester import Requester
 from .processors.unique import UniqueProcessor
-from .lib import QueueDone
-from .scraper import Scraper
+from .lib import QueueDone, Chunk, chunked, wait_all
+from .scraper import Scraper, BaseHandler
+from .autoscale import Autoscaler
+from .cache import ResponseCache
+from .checkpoint import Checkpointer
+from .retry import DeadLetterQueue
+from .metrics import PipelineMetrics, DisplayExporter
+from .sinks import Sink
+from .sources import Source, AsyncIterableSource
+from .distributed import Distributor
+from .tracing import Tracer
+from .frontier import FrontierQueue
+from .incremental import ChangeTracker
+from collections import defaultdict, deque
 import asyncio
+import copy
+import itertools
 import logging
+import signal
 import time
 
 logger = logging.getLogger("pipeline")
@@ -15,7 +30,22 @@ class Pipeline(object):
         global PIPELINE_IDX
 
         self.processes = []
+        self.stage_options = []
+        self.default_workers = None
+        self.default_retry = None
+        self.dead_letter_queue = None
+        self.default_queue_size = 5
+        self.input_queue_size = 10
+        self.autoscaler = None
+        self.checkpointer = None
+        self.distributor = None
+        self.tracer = None
+        self.changes = None
+        self.chunk_size = None
+        self.chunk_linger = None
+        self.consumed = 0
         self.plugins = []
+        self.exporters = []
         self.input = None
         self.output_func = lambda x: None
         self.prepend_host = ""
@@ -24,43 +54,122 @@ class Pipeline(object):
         self.not_found_contents = ""
 
         self.requester = None
+        self.requester_options = {}
         self.parent = None
         self.logger = logging.getLogger("pipeline-{0}".format(name or PIPELINE_IDX))
         self.processed = 0
         self.errors = {}
+        # Items taken off the last queue that are being compared with the previous run, and items waiting to be
+        # given to the output, saved by checkpoints
+        self.draining = []
+        self.unsent = []
 
         PIPELINE_IDX += 1
 
     def __call__(self, input_queue, output_queue, requester, parent):
         self.feed(input_queue)
         self.output(output_queue)
+        self.adopt(requester, parent)
+        return self
+
+    def adopt(self, requester, parent):
+        # Runs as part of another pipeline, sharing its requester, dead letter queue, tracer and change tracker
         self.requester = requester
         self.parent = parent
-        return self
+        if self.dead_letter_queue is None and parent is not None:
+            self.dead_letter_queue = parent.dead_letter_queue
+        if self.tracer is None and parent is not None:
+            self.tracer = parent.tracer
+        if self.changes is None and parent is not None:
+            self.changes = parent.changes
+        if self.chunk_size is None and parent is not None:
+            self.chunk_size, self.chunk_linger = parent.chunk_size, parent.chunk_linger
 
     @classmethod
     def parallel(cls, *pipes):
-        pass  # ToDo!
+        # Pipelines without their own feed() receive a copy of every item fed to the returned pipeline
+        return cls().feed(()).pipe(Parallel(pipes))
 
-    def pipe(self, process):
+    def pipe(self, process, workers=None, queue_size=None, retry=None, frontier=None):
+        # queue_size is the size of the queue feeding this stage. frontier=True, or a FrontierQueue, feeds the stage
+        # by priority and host instead of in order, keeping queue_size items in memory, see cyborg.frontier
         self.processes.append(process)
+        self.stage_options.append({"workers": workers, "queue_size": queue_size, "retry": retry, "frontier": frontier})
+        return self
+
+    def make_queue(self, idx, size):
+        frontier = self.stage_options[idx]["frontier"] if idx < len(self.stage_options) else None
+        if isinstance(frontier, FrontierQueue):
+            return frontier
+        if frontier:
+            queue_size = self.stage_options[idx]["queue_size"]
+            return FrontierQueue(queue_size) if queue_size else FrontierQueue()
+        return asyncio.Queue(size)
+
+    def defaults(self, workers=None, queue_size=None, retry=None):
+        self.default_workers = workers
+        self.default_retry = retry
+        if queue_size is not None:
+            self.default_queue_size = queue_size
+            self.input_queue_size = queue_size
+        return self
+
+    def chunks(self, size=100, linger=0.05):
+        # Moves items between stages in chunks of up to size items. A stage sends its outputs once it has size of
+        # them, once the first has waited linger seconds, or as soon as it has nothing else to do.
+        self.chunk_size = size
+        self.chunk_linger = linger
+        return self
+
+    def autoscale(self, max_workers=100, min_workers=1, interval=1.0):
+        self.autoscaler = Autoscaler(max_workers=max_workers, min_workers=min_workers, interval=interval)
+        return self
+
+    def checkpoint(self, path, interval=60, resume=False):
+        self.checkpointer = Checkpointer(path, interval=interval, resume=resume)
+        return self
+
+    def distribute(self, workers, queue_size=100):
+        # Runs the pipeline in several processes, see cyborg.distributed
+        self.distributor = Distributor(self, workers, queue_size=queue_size)
+        return self
+
+    def trace(self, path, sample=1.0, threshold=0.0, top=10, profile=False, interval=0.005):
+        # Writes a span for every item handled by every stage to path, see cyborg.tracing
+        self.tracer = Tracer(path, sample=sample, threshold=threshold, top=top, profile=profile, interval=interval)
+        return self
+
+    def incremental(self, path, key=None):
+        # Only outputs the records that are new, changed or deleted since the previous run, see cyborg.incremental.
+        # key is a field name or a function identifying records, by default the key of the last unique() stage.
+        self.changes = ChangeTracker(path, key=key)
+        return self
+
+    def export(self, exporter):
+        # exporter is a JsonLinesExporter, PrometheusExporter or any other metrics.Exporter
+        self.exporters.append(exporter)
+        return self
+
+    def dead_letters(self, path):
+        self.dead_letter_queue = DeadLetterQueue(path)
         return self
 
     def error(self, server_error="", not_found=""):
         self.error_contents = server_error
         self.not_found_contents = not_found
 
-    def unique(self, key):
-        self.processes.append(
-            UniqueProcessor(key=key)
-        )
-        return self
+    def unique(self, key, store=None, workers=None, queue_size=None):
+        return self.pipe(UniqueProcessor(key=key, store=store), workers=workers, queue_size=queue_size)
 
     def feed(self, input):
+        # input is an iterable, an async iterable, a queue, or a Source from cyborg.sources
+        if hasattr(input, "__aiter__"):
+            input = AsyncIterableSource(input)
         self.input = input
         return self
 
     def output(self, output_func):
+        # output_func is a function or coroutine called with each item, a queue, or a Sink from cyborg.sinks
         self.output_func = output_func
         return self
 
@@ -68,88 +177,452 @@ class Pipeline(object):
         self.prepend_host = host
         return self
 
+    def connections(self, limit=None, per_host=None, keepalive=None, dns_cache_ttl=None):
+        options = {
+            "connection_limit": limit,
+            "per_host_limit": per_host,
+            "keepalive_timeout": keepalive,
+            "dns_cache_ttl": dns_cache_ttl
+        }
+        self.requester_options.update({k: v for k, v in options.items() if v is not None})
+        return self
+
+    def rate_limit(self, rate=None, burst=1, adaptive=False, max_concurrency=64, latency_target=None):
+        self.requester_options.update(rate_limit=rate, burst=burst, adaptive=adaptive,
+                                      max_concurrency=max_concurrency, latency_target=latency_target)
+        return self
+
+    def timeouts(self, connect=None, first_byte=None, total=None, max_body_size=None):
+        options = {
+            "connect_timeout": connect,
+            "first_byte_timeout": first_byte,
+            "total_timeout": total,
+            "max_body_size": max_body_size
+        }
+        self.requester_options.update({k: v for k, v in options.items() if v is not None})
+        return self
+
+    def dedup_urls(self, mode="skip", normalize=None, memory=1000):
+        self.requester_options.update(dedup_urls=mode, url_memory=memory)
+        if normalize is not None:
+            self.requester_options["normalize"] = normalize
+        return self
+
+    def cache(self, path, ttl=86400, max_size=1024 ** 3, offline=False):
+        self.requester_options["cache"] = ResponseCache(path, ttl=ttl, max_size=max_size, offline=offline)
+        return self
+
+    def parser(self, mode, workers=None):
+        self.requester_options.update(parser=mode, parse_workers=workers)
+        return self
+
+    def make_requester(self):
+        return Requester(
+            error_contents=self.error_contents,
+            not_found_contents=self.not_found_contents,
+            **self.requester_options
+        )
+
     def use(self, name):
         self.plugins.append(name)
         return self
 
-    @asyncio.coroutine
-    def start(self):
+    def run(self):
+        # Runs the pipeline in a new event loop. Ctrl-C or SIGTERM stop it gracefully: stages are cancelled, buffered
+        # output is written and a checkpoint saved if enabled. Returns False when the pipeline was stopped this way.
+        return asyncio.run(self.run_until_stopped())
+
+    async def run_until_stopped(self):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        stopped, handled = [], []
+
+        def stop(sig):
+            logger.warning("Received {0}, stopping the pipeline".format(signal.Signals(sig).name))
+            stopped.append(sig)
+            # A second Ctrl-C stops at once
+            for sig in handled:
+                loop.remove_signal_handler(sig)
+            task.cancel()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop, sig)
+                handled.append(sig)
+            except (NotImplementedError, RuntimeError):
+                # Not supported on Windows or outside the main thread, Ctrl-C raises KeyboardInterrupt there
+                pass
+
+        try:
+            await self.start()
+        except asyncio.CancelledError:
+            if not stopped:
+                raise
+            return False
+        finally:
+            for sig in handled:
+                loop.remove_signal_handler(sig)
+        return True
+
+    async def start(self):
         start = time.time()
         logger.info("Starting pipeline")
-        requester = self.requester or Requester(
-            error_contents=self.error_contents,
-            not_found_contents=self.not_found_contents
-        )
-
+        owns_changes = self.changes is not None and not self.changes.running
+        if owns_changes:
+            unique_keys = [process.DEDUP_KEY for process in self.processes if hasattr(process, "DEDUP_KEY")]
+            await self.changes.open(unique_keys[-1] if unique_keys else None)
+
+        try:
+            if self.distributor is not None:
+                if self.checkpointer is not None:
+                    logger.warning("Checkpoints are not supported when running in several processes")
+                if self.tracer is not None:
+                    logger.warning("Tracing is not supported when running in several processes")
+                if self.changes is not None:
+                    logger.warning("Unchanged pages are not skipped and deleted records are not reported when running "
+                                   "in several processes")
+                await self.distributor.run(start)
+                return
+            # Nested pipelines share the requester (and its connection pool) of their parent
+            owns_requester = self.requester is None
+            requester = self.requester or self.make_requester()
+            owns_tracer = self.tracer is not None and not self.tracer.running
+            if owns_tracer:
+                self.tracer.open()
+
+            try:
+                await self._run(requester, start)
+            finally:
+                if owns_tracer:
+                    self.tracer.close()
+                if owns_requester:
+                    await requester.close()
+        finally:
+            if owns_changes:
+                await self.changes.close()
+            if self.dead_letter_queue is not None:
+                await self.dead_letter_queue.flush()
+
+    async def _run(self, requester, start):
         futures, processes = [], []
+        queue_sizes = [options["queue_size"] for options in self.stage_options]
+
+        restored = self.checkpointer.load() if self.checkpointer is not None else None
+        # Only the outermost pipeline compares its output with the previous run
+        changes = self.changes if not isinstance(self.output_func, asyncio.Queue) else None
+        prefill = [[] for _ in range(len(self.processes) + 1)]
+        if restored is not None:
+            for idx, items in enumerate(restored["queues"]):
+                prefill[idx].extend(items)
+            for idx, state in enumerate(restored["stages"]):
+                if state is not None:
+                    prefill[idx].extend(state["requeue"])
+                    prefill[idx + 1].extend(state["forward"])
+            self.consumed = restored["consumed"]
+            self.processed = restored["processed"]
+            if restored["changes"] is not None and changes is not None:
+                await changes.resume(restored["changes"])
+        else:
+            # A fresh run reads its input from the start, also when the pipeline ran before
+            self.consumed = 0
+            self.processed = 0
+
         if isinstance(self.input, asyncio.Queue):
             input_q = self.input
         else:
-            input_q = asyncio.JoinableQueue(maxsize=10)
+            input_q = self.make_queue(0, ((queue_sizes[:1] or [None])[0] or self.input_queue_size) + len(prefill[0]))
 
-        process_queues = [input_q] + [asyncio.JoinableQueue(5) for _ in range(len(self.processes))]
+        # Queues are made big enough to take back the items saved in a checkpoint
+        process_queues = [input_q] + [self.make_queue(idx, (size or self.default_queue_size) + len(items))
+                                      for idx, (size, items) in enumerate(zip(queue_sizes[1:] + [None], prefill[1:]),
+                                                                          start=1)]
+
+        for queue, items in zip(process_queues, prefill):
+            for item in items:
+                queue.put_nowait(item)
 
         logger.info("Created {0} queues".format(len(process_queues)))
 
         for idx, process_cls in enumerate(self.processes):
             process = process_cls(process_queues[idx], process_queues[idx+1], requester, self)
 
-            if isinstance(process, (Scraper, Pipeline)) and self.prepend_host:
+            if restored is not None and restored["stages"][idx] is not None:
+                process.restore(restored["stages"][idx])
+
+            if self.checkpointer is not None and isinstance(process, (Pipeline, ParallelStage)):
+                logger.warning("Items inside nested pipelines are not checkpointed, they restart from their input")
+
+            workers = self.stage_options[idx]["workers"] or self.default_workers
+            if workers and isinstance(process, BaseHandler):
+                process.set_workers(workers)
+
+            retry = self.stage_options[idx]["retry"] or self.default_retry
+            if retry is not None and isinstance(process, BaseHandler):
+                process.retry_policy = retry
+
+            if isinstance(process, (Scraper, Pipeline, ParallelStage)) and self.prepend_host:
                 process.set_host(self.prepend_host)
 
             logger.info("Starting process {0}".format(process))
             processes.append(process)
             futures.append(process.start())
+        self.stages = processes
+
+        if isinstance(self.input, Source):
+            logger.info("Using {0} input".format(self.input.__class__.__name__))
+
+            async def _input_func():
+                source, skip = self.input, self.consumed
+                await source.open()
+                try:
+                    while True:
+                        batch = await source.next_batch()
+                        if batch is None:
+                            break
+                        # When resuming, skip the items consumed before the checkpoint
+                        if skip:
+                            batch, skip = batch[skip:], max(skip - len(batch), 0)
+                        for item in chunked(batch, self.chunk_size or 1):
+                            await input_q.put(item)
+                            self.consumed += len(item) if isinstance(item, Chunk) else 1
+                finally:
+                    await source.close()
+                logger.info("Input source exhausted")
+
+                await input_q.put(QueueDone)
 
-        if not isinstance(self.input, asyncio.Queue):
+            futures.append(_input_func())
+
+        elif not isinstance(self.input, asyncio.Queue):
             logger.info("Using iterable input queue")
 
-            @asyncio.coroutine
-            def _input_func():
-                for item in self.input:
-                    yield from input_q.put(item)
+            async def _input_func():
+                # When resuming, skip the items consumed before the checkpoint
+                for item in chunked(itertools.islice(self.input, self.consumed, None), self.chunk_size or 1):
+                    await input_q.put(item)
+                    self.consumed += len(item) if isinstance(item, Chunk) else 1
                 logger.info("Input queue drained")
 
-                yield from input_q.put(QueueDone)
+                await input_q.put(QueueDone)
 
             futures.append(_input_func())
 
-        @asyncio.coroutine
-        def status_task():
-            nonlocal process_queues
-            while True:
-                yield from asyncio.sleep(1)
-                for p in processes:
-                    print("{0:<20s}: {1:>6d}: {2}".format(p.__class__.__name__,
-                                                          p.processed,
-                                                          {k: v for k,v in p.errors.items() if v != 0}))
-                print(" ")
-
+        metrics = PipelineMetrics(self, processes, requester)
+        exporters = list(self.exporters)
         if "display" in self.plugins:
-            asyncio.async(status_task())
-
-        [asyncio.async(f) for f in futures]
-
-        exit_queue = process_queues[-1]
-
+            exporters.append(DisplayExporter())
+
+        # Background tasks run until the pipeline finishes
+        background = [asyncio.create_task(exporter.run(metrics)) for exporter in exporters]
+
+        if self.autoscaler is not None:
+            background.append(asyncio.create_task(
+                self.autoscaler.run([p for p in processes if isinstance(p, BaseHandler)])
+            ))
+
+        sink = self.output_func if isinstance(self.output_func, Sink) else None
+
+        def take_snapshot():
+            # Output that had not been written by the sink yet, as (data, url) pairs
+            output = [item if sink.WHOLE_ITEMS else (item, None) for item in sink.pending()] if sink is not None else []
+            return self.checkpointer.snapshot(process_queues, processes, self.consumed, self.processed,
+                                              output + self.unsent, self.draining,
+                                              changes.checkpoint() if changes is not None else None)
+
+        if self.checkpointer is not None:
+            background.append(asyncio.create_task(self.checkpointer.run(take_snapshot)))
+
+        tasks = [asyncio.create_task(f) for f in futures]
+        tasks.append(asyncio.create_task(self._drain(process_queues[-1], start,
+                                                     restored["output"] if restored is not None else ())))
+
+        try:
+            # The pipeline fails as soon as one of its stages does
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        except BaseException:
+            # Cancelled tasks only stop at their next await, so the checkpoint still has the items they were handling
+            for task in tasks:
+                task.cancel()
+            if sink is not None:
+                sink.abort()
+            if self.checkpointer is not None:
+                self.checkpointer.write(take_snapshot())
+                logger.info("Saved checkpoint to {0}".format(self.checkpointer.path))
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            for task in background:
+                task.cancel()
+            for exporter in exporters:
+                exporter.close(metrics)
+            for queue in process_queues:
+                if isinstance(queue, FrontierQueue):
+                    queue.close()
+
+        if self.checkpointer is not None:
+            self.checkpointer.clear()
+
+    async def _drain(self, exit_queue, start, restored_output=()):
         if isinstance(self.output_func, asyncio.Queue):
             output_func = self.output_func.put
+        elif isinstance(self.output_func, Sink):
+            output_func = self.output_func.put
+            await self.output_func.start()
         else:
             output_func = self.output_func
+        # Only the outermost pipeline compares its output with the previous run
+        changes = self.changes if not isinstance(self.output_func, asyncio.Queue) else None
+
+        async def emit(item):
+            if isinstance(self.output_func, Sink) and self.output_func.WHOLE_ITEMS:
+                await output_func(item)
+            elif isinstance(self.output_func, Sink) or asyncio.iscoroutinefunction(output_func):
+                await output_func(item[0])
+            else:
+                output_func(item[0])
+
+        # Output saved by a checkpoint has already been compared with the previous run
+        for item in restored_output:
+            await emit(item)
 
         while True:
-            item = yield from exit_queue.get()
+            item = await exit_queue.get()
 
             if item is QueueDone:
+                # Failures in other processes are not seen here, so they may have left records out of the output
+                if changes is not None and self.distributor is None:
+                    for deleted in await changes.deletions():
+                        await emit((deleted, None))
+                if isinstance(self.output_func, Sink):
+                    await self.output_func.finish()
+                if changes is not None:
+                    await changes.commit()
+
                 end = time.time()
                 logger.info("Pipeline complete in {0}s".format(end - start))
 
                 if isinstance(self.output_func, asyncio.Queue):
-                    yield from self.output_func.put(QueueDone)
+                    await self.output_func.put(QueueDone)
 
                 return
-            self.processed += 1
-            if asyncio.iscoroutinefunction(output_func):
-                yield from output_func(item[0])
+
+            if isinstance(self.output_func, asyncio.Queue):
+                # Used as a stage of another pipeline, pass on the (data, url) pairs untouched
+                self.processed += len(item) if isinstance(item, Chunk) else 1
+                await output_func(item)
+                continue
+
+            items = list(item) if isinstance(item, Chunk) else [item]
+            if self.tracer is not None:
+                for item in items:
+                    self.tracer.discard(item)
+            if changes is not None:
+                self.draining = items
+                found = await changes.compare([data for data, _ in items])
+                self.draining = []
+                self.processed += len(items)
+                self.unsent = [(change, url) for change, (_, url) in zip(found, items) if change is not None]
+            else:
+                self.processed += len(items)
+                self.unsent = items
+            while self.unsent:
+                # Taken off before it is output, a sink holds it from then on
+                await emit(self.unsent.pop(0))
+
+
+class Parallel(object):
+    def __init__(self, pipes):
+        self.pipes = pipes
+
+    def __call__(self, input_queue, output_queue, requester, parent):
+        return ParallelStage(self.pipes, input_queue, output_queue, requester, parent)
+
+
+class ParallelStage(object):
+    def __init__(self, pipes, input_queue, output_queue, requester, parent):
+        self.pipes = pipes
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.requester = requester
+        self.parent = parent
+        self.logger = logging.getLogger("parallel")
+
+        self.queue_size = parent.default_queue_size if parent is not None else 5
+        self.processed = 0
+        self.errors = defaultdict(int)
+
+    def set_host(self, host):
+        for pipe in self.pipes:
+            if not pipe.prepend_host:
+                pipe.set_host(host)
+
+    async def start(self):
+        shared_inputs, outputs, branches = [], [], []
+
+        for pipe in self.pipes:
+            output_q = asyncio.Queue(self.queue_size)
+            outputs.append(output_q)
+
+            if pipe.input is None:
+                input_q = asyncio.Queue(self.queue_size)
+                shared_inputs.append(input_q)
+                pipe(input_q, output_q, self.requester, self.parent)
             else:
-                output_func(item[0])
\ No newline at end of file
+                pipe.output(output_q)
+                pipe.adopt(self.requester, self.parent)
+
+            branches.append(asyncio.create_task(pipe.start()))
+
+        await wait_all([asyncio.create_task(self.fan_out(shared_inputs)),
+                        asyncio.create_task(self.fan_in(outputs))] + branches)
+
+        for pipe in self.pipes:
+            for key, value in pipe.errors.items():
+                self.errors[key] += value
+
+    async def fan_out(self, queues):
+        # The input queue is drained even when every branch has its own feed, so our producer is never blocked
+        while True:
+            item = await self.input_queue.get()
+            for idx, queue in enumerate(queues):
+                await queue.put(item if idx == 0 or item is QueueDone else copy.deepcopy(item))
+            self.input_queue.task_done()
+
+            if item is QueueDone:
+                return
+
+    async def fan_in(self, queues):
+        # Take at most one item from each branch per round so a busy branch cannot starve the others
+        getters = {idx: asyncio.create_task(queue.get()) for idx, queue in enumerate(queues)}
+        order = deque(range(len(queues)))
+
+        try:
+            while getters:
+                await asyncio.wait(list(getters.values()), return_when=asyncio.FIRST_COMPLETED)
+
+                for idx in list(order):
+                    getter = getters.get(idx)
+                    if getter is None or not getter.done():
+                        continue
+
+                    item = getter.result()
+                    queues[idx].task_done()
+
+                    if item is QueueDone:
+                        del getters[idx]
+                        order.remove(idx)
+                        continue
+
+                    self.processed += len(item) if isinstance(item, Chunk) else 1
+                    await self.output_queue.put(item)
+                    getters[idx] = asyncio.create_task(queues[idx].get())
+
+                order.rotate(-1)
+        finally:
+            for getter in getters.values():
+                getter.cancel()
+
+        self.logger.info("All {0} branches complete".format(len(queues)))
+        await self.output_queue.put(QueueDone)
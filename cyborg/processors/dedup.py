@@ -0,0 +1,208 @@
+import array
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import sys
+
+logger = logging.getLogger("dedup")
+
+
+def key_digest(key, size=8):
+    # hash() is randomised per process, a digest of the repr is stable across restarts
+    return hashlib.sha1(repr(key).encode("utf-8")).digest()[:size]
+
+
+class DedupStore(object):
+    def add(self, key):
+        # Returns True if the key had not been seen before
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def memory_usage(self):
+        return 0
+
+    def disk_usage(self):
+        return 0
+
+    def dump(self):
+        # Picklable state saved in pipeline checkpoints
+        return None
+
+    def load(self, state):
+        pass
+
+    def close(self):
+        pass
+
+
+class DictStore(DedupStore):
+    # Keeps the keys themselves, exact but grows with the size of the keys
+
+    def __init__(self):
+        self.keys = set()
+        self.key_bytes = 0
+
+    def add(self, key):
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        self.key_bytes += sys.getsizeof(key)
+        return True
+
+    def __len__(self):
+        return len(self.keys)
+
+    def memory_usage(self):
+        return sys.getsizeof(self.keys) + self.key_bytes
+
+    def dump(self):
+        return set(self.keys)
+
+    def load(self, state):
+        self.keys = set(state)
+        self.key_bytes = sum(sys.getsizeof(key) for key in self.keys)
+
+
+class HashedStore(DedupStore):
+    # Stores a 64 bit digest of each key in an open addressing table, 16 bytes per key at most.
+    # Two keys sharing a digest are treated as duplicates, which is very unlikely below billions of keys.
+
+    def __init__(self, capacity=1024):
+        self.table = array.array("Q", bytes(8 * self.round_capacity(capacity)))
+        self.count = 0
+
+    @staticmethod
+    def round_capacity(capacity):
+        return 1 << max(4, math.ceil(math.log2(capacity)))
+
+    def insert(self, table, value):
+        mask = len(table) - 1
+        slot = value & mask
+        while table[slot]:
+            if table[slot] == value:
+                return False
+            slot = (slot + 1) & mask
+        table[slot] = value
+        return True
+
+    def grow(self):
+        table = array.array("Q", bytes(16 * len(self.table)))
+        for value in self.table:
+            if value:
+                self.insert(table, value)
+        self.table = table
+
+    def add(self, key):
+        # 0 marks an empty slot
+        value = int.from_bytes(key_digest(key), "little") or 1
+        if not self.insert(self.table, value):
+            return False
+
+        self.count += 1
+        if self.count * 10 > len(self.table) * 6:
+            self.grow()
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def memory_usage(self):
+        return self.table.itemsize * len(self.table)
+
+    def dump(self):
+        return self.table.tobytes(), self.count
+
+    def load(self, state):
+        self.table = array.array("Q")
+        self.table.frombytes(state[0])
+        self.count = state[1]
+
+
+class BloomFilterStore(DedupStore):
+    # Fixed memory, but a new key is reported as a duplicate with probability error_rate once
+    # capacity keys have been added. The error rate climbs quickly past capacity.
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        digest = key_digest(key, 16)
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        new = False
+        for position in self.positions(key):
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not self.bits[byte] & bit:
+                self.bits[byte] |= bit
+                new = True
+
+        if new:
+            self.count += 1
+            if self.count == self.capacity + 1:
+                logger.warning("Bloom filter is over capacity ({0}), false positive rate will "
+                               "exceed {1}".format(self.capacity, self.error_rate))
+        return new
+
+    def __len__(self):
+        return self.count
+
+    def memory_usage(self):
+        return len(self.bits)
+
+    def dump(self):
+        return bytes(self.bits), self.count
+
+    def load(self, state):
+        self.bits = bytearray(state[0])
+        self.count = state[1]
+
+
+class SqliteStore(DedupStore):
+    # Keeps 128 bit digests on disk so the seen keys survive restarts
+
+    def __init__(self, path, commit_every=1000):
+        self.path = path
+        self.commit_every = commit_every
+        self.pending = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS seen (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.count = self.connection.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+    def add(self, key):
+        cursor = self.connection.execute("INSERT OR IGNORE INTO seen VALUES (?)", (key_digest(key, 16),))
+        if not cursor.rowcount:
+            return False
+
+        self.count += 1
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.connection.commit()
+            self.pending = 0
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def disk_usage(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def dump(self):
+        # The keys are already on disk, make sure they are committed
+        self.connection.commit()
+        self.pending = 0
+        return None
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -1,32 +1,81 @@
+from ..lib import Chunk
 from ..scraper import Processor
-import asyncio
+from .dedup import DedupStore, DictStore
 import operator
 
 
-def UniqueProcessor(key):
+def UniqueProcessor(key, store=None):
     if isinstance(key, str):
         key_func = operator.itemgetter(key)
     elif callable(key):
         key_func = key
     else:
         raise RuntimeError("Key is not a string or callable")
-        
-    # This is a simple implementation that uses a dictionary. Could be improved a lot.
+
+    # store is a DedupStore, or a callable returning one for each processor created from this class
 
     class _UniqueProcessor(Processor):
+        # Used to route items by key when the pipeline runs in several processes
+        DEDUP_KEY = staticmethod(key_func)
+        PROCESS_CHUNKS = True
+
         def __init__(self, *args, **kwargs):
-            self.seen_keys = {}
+            if store is None:
+                self.store = DictStore()
+            elif isinstance(store, DedupStore):
+                self.store = store
+            else:
+                self.store = store()
+            self.checked = 0
             super().__init__(*args, **kwargs)
 
-        @asyncio.coroutine
-        def process(self, data, url):
+        async def process(self, data, url):
             nonlocal key_func
-            key = key_func(data)
-            if key in self.seen_keys:
+            self.checked += 1
+            is_new = self.store.add(key_func(data))
+            if not is_new:
                 self.errors["duplicates"] += 1
-                return None
-            else:
-                self.seen_keys[key] = 0
-                return data, url
+            self.update_stats()
+
+            return (data, url) if is_new else None
+
+        async def process_chunk(self, items):
+            # Every key is read before any is added, so an item without one fails the chunk with the store untouched
+            keys = [key_func(data) for data, _ in items]
+            new_items = []
+            for key, item in zip(keys, items):
+                if self.store.add(key):
+                    new_items.append(item)
+                else:
+                    self.errors["duplicates"] += 1
+            self.checked += len(items)
+            self.update_stats()
+            return new_items
+
+        def update_stats(self):
+            self.stats["dedup_memory"] = self.store.memory_usage()
+            self.stats["dedup_hit_rate"] = self.errors["duplicates"] / self.checked
+
+        def checkpoint(self):
+            state = super().checkpoint()
+            # Running items have already been added to the store and only wait on the next stage, so on resume
+            # they are passed on to it rather than checked again (which would drop them as duplicates). Those already
+            # output are in the outbox or a chunk being sent, and forwarded with it.
+            output = {id(data) for data, _ in state["forward"]}
+            for value in self.in_flight.values():
+                for obj in value if isinstance(value, Chunk) else [value]:
+                    if id(obj[0] if isinstance(obj, tuple) else obj) not in output:
+                        state["forward"].append(obj)
+            state["requeue"] = self.unstarted()
+            state["store"] = self.store.dump()
+            return state
+
+        def restore(self, state):
+            super().restore(state)
+            self.store.load(state["store"])
+
+        async def complete(self):
+            self.stats["dedup_disk"] = self.store.disk_usage()
+            self.store.close()
 
     return _UniqueProcessor
@@ -0,0 +1,105 @@
+import asyncio
+import time
+from .lib import Limit
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # Tokens are reserved up front and may go negative, so waiters are served in the order they arrived
+        self.refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def pause(self, seconds):
+        self.refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class AdaptiveLimit(Limit):
+    # Additive increase while requests succeed with a healthy latency, multiplicative decrease on failures
+
+    def __init__(self, size=4, maximum=64, latency_target=None):
+        super().__init__(size)
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.latency = None
+        self.best_latency = None
+        self.successes = 0
+        self.last_backoff = 0
+
+    def healthy(self):
+        if self.latency_target is not None:
+            return self.latency <= self.latency_target
+        return self.latency <= self.best_latency * 2
+
+    def record(self, latency, failed):
+        if failed:
+            # Requests that were already in flight fail together, only back off once per round trip
+            now = time.monotonic()
+            if now - self.last_backoff > (self.latency or latency):
+                self.last_backoff = now
+                self.resize(self.size // 2)
+            self.successes = 0
+            return
+
+        self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+        self.best_latency = self.latency if self.best_latency is None else min(self.best_latency, self.latency)
+
+        self.successes += 1
+        if self.successes >= self.size and self.size < self.maximum and self.healthy():
+            self.successes = 0
+            self.resize(self.size + 1)
+
+
+class HostLimiter(object):
+    def __init__(self, rate=None, burst=1, adaptive=False, concurrency=4, max_concurrency=64, latency_target=None):
+        self.rate = rate
+        self.burst = burst
+        self.adaptive = adaptive
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+
+        self.buckets = {}
+        self.limits = {}
+
+    def bucket(self, host):
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+    def limit(self, host):
+        if host not in self.limits:
+            self.limits[host] = AdaptiveLimit(self.concurrency, self.max_concurrency, self.latency_target)
+        return self.limits[host]
+
+    async def acquire(self, host):
+        if self.adaptive:
+            await self.limit(host).acquire()
+        if self.rate:
+            await self.bucket(host).acquire()
+
+    def release(self, host, latency, failed):
+        if self.adaptive:
+            limit = self.limit(host)
+            limit.release()
+            limit.record(latency, failed)
+
+    def pause(self, host, seconds):
+        if self.rate:
+            self.bucket(host).pause(seconds)
+
+    def concurrency_of(self, host):
+        return self.limits[host].size if host in self.limits else None
@@ -3,15 +3,37 @@ import aiohttp
 import logging
 import lxml.html
 import json
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from .selector import Selector
+from .ratelimit import HostLimiter
+from .urls import normalize_url
+from collections import OrderedDict
+from multidict import CIMultiDict
 
 logger = logging.getLogger("requester")
 
+INLINE, THREAD, PROCESS = "inline", "thread", "process"
+SKIP, MEMORY = "skip", "memory"
+HTML, JSON = "html", "json"
+PARSERS = (INLINE, THREAD, PROCESS)
+# The JSON value of a response that has not been decoded yet, as None is a valid value
+NOT_PARSED = object()
+
+
+def parse_html(data):
+    started = time.perf_counter()
+    node = lxml.html.fromstring(data)
+    return node, time.perf_counter() - started
+
 
 class RequestError(RuntimeError):
-    def __init__(self, url, *args, **kwargs):
+    def __init__(self, url, *args, body=None):
         self.url = url
-        super().__init__(*args, **kwargs)
+        # The page that caused the error, if it was downloaded
+        self.body = body
+        super().__init__(*args)
 
 
 class ServerError(RequestError):
@@ -22,59 +44,390 @@ class NotFoundError(RequestError):
     pass
 
 
+class RequestTimeout(RequestError):
+    def __init__(self, url, phase):
+        # phase is "connect", "first_byte" or "total"
+        self.phase = phase
+        super().__init__(url, "{0} timeout exceeded".format(phase.replace("_", " ").capitalize()))
+
+
+class BodyTooLargeError(RequestError):
+    pass
+
+
+class DuplicateURLError(RequestError):
+    pass
+
+
+class CacheMissError(RequestError):
+    pass
+
+
 class HttpError(RequestError):
-    def __init__(self, url, code):
+    def __init__(self, url, code, retry_after=None):
         self.code = code
+        self.retry_after = retry_after
         super().__init__(url, "HTTP {0} encountered".format(self.code))
 
 
+def body_size(response):
+    # Bytes of the body downloaded for a response, pages served from the cache were not downloaded
+    return getattr(response, "body_size", 0)
+
+
+def sniff_content_type(headers, content):
+    content_type = headers.get("Content-Type", "").lower()
+    if "json" in content_type:
+        return JSON
+    elif "html" in content_type or "xml" in content_type:
+        return HTML
+
+    if content.lstrip()[:1] in ("{", "["):
+        return JSON
+    return HTML
+
+
 class Response(Selector):
-    def __init__(self, response, content, node):
+    # The JSON value and the HTML document are both built on first access, so a JSON API response is
+    # never parsed as HTML and an HTML page never goes through json.loads().
+    def __init__(self, response, content, expects=None, node=None, parse_time=0.0, headers=None):
+        if expects not in (None, HTML, JSON):
+            raise RuntimeError("Unknown content type {0}, expected html or json".format(expects))
+
         self.response = response
-        self.is_json = False
+        self.body = content
+        self.headers = CIMultiDict(headers if headers is not None else (response.headers if response is not None else {}))
+        self.content_type = expects or sniff_content_type(self.headers, content)
+        self.parse_time = parse_time
+        self.fetch_time = 0.0
 
-        try:
-            self.content = json.loads(content)
-            self.is_json = True
-        except Exception:
-            self.content = content
+        self._document = node
+        self._json = NOT_PARSED
+        self._attr = None
+        self._classes = None
+
+    @property
+    def is_json(self):
+        return self.content_type == JSON
+
+    @property
+    def json(self):
+        if self._json is NOT_PARSED:
+            self._json = json.loads(self.body)
+        return self._json
+
+    @property
+    def content(self):
+        return self.json if self.is_json else self.body
 
-        super().__init__(node)
+    @property
+    def document(self):
+        if self._document is None:
+            self._document, self.parse_time = parse_html(self.body)
+        return self._document
 
     def __getitem__(self, item):
         if self.is_json:
-            return self.content[item]
+            return self.json[item]
         else:
             raise RuntimeError("Response is not JSON")
 
 
 class Requester(object):
-    def __init__(self, error_contents="", not_found_contents=""):
+    def __init__(self, error_contents="", not_found_contents="",
+                 connection_limit=100, per_host_limit=10,
+                 keepalive_timeout=30, dns_cache_ttl=300,
+                 parser=INLINE, parse_workers=None,
+                 rate_limit=None, burst=1, adaptive=False, max_concurrency=64, latency_target=None,
+                 dedup_urls=None, normalize=normalize_url, url_memory=1000,
+                 cache=None,
+                 connect_timeout=10, first_byte_timeout=30, total_timeout=120, max_body_size=10 * 1024 ** 2):
+        if parser not in PARSERS:
+            raise RuntimeError("Unknown parser {0}, expected one of {1}".format(parser, PARSERS))
+        if dedup_urls not in (None, SKIP, MEMORY):
+            raise RuntimeError("Unknown URL dedup mode {0}, expected skip or memory".format(dedup_urls))
+
         self.error_contents = error_contents
         self.not_found_contents = not_found_contents
 
-    @asyncio.coroutine
-    def get(self, url):
-        logger.info("Requesting {0}".format(url))
+        self.connection_limit = connection_limit
+        self.per_host_limit = per_host_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+
+        self.parser = parser
+        self.parse_workers = parse_workers
+
+        self.connect_timeout = connect_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self.total_timeout = total_timeout
+        self.max_body_size = max_body_size
+
+        self.session = None
+        self.executor = None
+        self.requests = 0
+        self.bytes_downloaded = 0
+
+        # Requests in flight are shared between callers asking for the same URL. Once fetched a URL is either
+        # skipped or, in memory mode, served from the url_memory most recently fetched responses.
+        self.dedup_urls = dedup_urls
+        self.normalize = normalize
+        self.url_memory = url_memory
+        self.inflight = {}
+        self.fetched = set()
+        self.memory = OrderedDict()
+
+        # A ResponseCache, pages are served from disk while fresh and revalidated with conditional requests after
+        self.cache = cache
+
+        self.limiter = None
+        # With adaptive limits the limiter controls how many requests go to each host, starting from per_host_limit.
+        # The connector only enforces the ceiling so it does not stop the limit from growing.
+        self.connector_per_host = max_concurrency if adaptive else per_host_limit
+        if rate_limit or adaptive:
+            self.limiter = HostLimiter(rate=rate_limit, burst=burst, adaptive=adaptive,
+                                       concurrency=min(per_host_limit or max_concurrency, max_concurrency),
+                                       max_concurrency=max_concurrency, latency_target=latency_target)
+
+    def get_session(self):
+        # The session is created lazily so that it is bound to the loop that runs the pipeline
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connector_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=self.dns_cache_ttl is not None,
+                ttl_dns_cache=self.dns_cache_ttl
+            )
+            # Connecting is timed by aiohttp, the first byte and total timeouts are enforced in download()
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    def get_executor(self):
+        if self.executor is None:
+            if self.parser == THREAD:
+                self.executor = ThreadPoolExecutor(self.parse_workers or 4)
+            elif self.parser == PROCESS:
+                self.executor = ProcessPoolExecutor(self.parse_workers)
+        return self.executor
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+        if self.cache is not None:
+            await self.cache.close()
+
+    async def run_detached(self, func, *args):
+        # Runs func in the parse executor. In process mode the arguments and result must be picklable.
+        return await asyncio.get_running_loop().run_in_executor(self.get_executor(), func, *args)
+
+    async def get(self, url, expects=None, dedup=True, until=None):
+        started = time.perf_counter()
+        response, data = await self.fetch(url, dedup, until)
+        result = Response(response, data, expects)
+        result.fetch_time = time.perf_counter() - started
+        # The document is parsed on first access, or ahead of time by parse()
+        return result
+
+    async def parse(self, response):
+        # Parses an HTML response in the parser thread pool so that accessing its document does not block the loop.
+        # In the other modes the document is left to be parsed on first access: lxml trees cannot be sent between
+        # processes, scrapers use run_detached() to parse and scrape remotely.
+        if self.parser == THREAD and response.content_type == HTML and response._document is None:
+            response._document, response.parse_time = await asyncio.get_running_loop().run_in_executor(
+                self.get_executor(), parse_html, response.body
+            )
+        return response
+
+    async def fetch(self, url, dedup=True, until=None):
+        if until is not None:
+            # A body cut short is not the whole page, so it is neither cached nor shared with other callers
+            return await self.limited_download(url, until=until)
+
+        if self.dedup_urls is None or not dedup:
+            return await self.cached_download(url)
+
+        key = self.normalize(url)
+
+        if self.dedup_urls == SKIP:
+            if key in self.inflight or key in self.fetched:
+                raise DuplicateURLError(url)
+        else:
+            if key in self.inflight:
+                return await asyncio.shield(self.inflight[key])
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        future = self.inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self.cached_download(url)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as ex:
+            future.set_exception(ex)
+            # Mark the exception as retrieved, it is raised below whether or not anyone else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.inflight[key]
+
+        # Failed URLs are not remembered so they can be requested again
+        self.fetched.add(key)
+        if self.dedup_urls == MEMORY and self.url_memory:
+            self.memory[key] = result
+            if len(self.memory) > self.url_memory:
+                self.memory.popitem(last=False)
+
+        return result
+
+    async def cached_download(self, url):
+        if self.cache is None:
+            return await self.limited_download(url)
+
+        entry = await self.cache.lookup(url)
+        if entry is not None and self.cache.is_fresh(entry):
+            data = await self.cache.load(entry)
+            if data is not None:
+                return entry.response, data
+
+        if self.cache.offline:
+            raise CacheMissError(url)
+
+        headers = entry.conditional_headers() if entry is not None else None
+        response, data = await self.limited_download(url, headers)
+
+        if response.status == 304 and entry is not None:
+            data = await self.cache.load(entry)
+            if data is not None:
+                await self.cache.revalidated(url)
+                return entry.response, data
+            # The body went missing from the cache, fetch it again without the conditional headers
+            response, data = await self.limited_download(url)
+
+        await self.cache.store(url, response, data)
+        return response, data
+
+    async def limited_download(self, url, headers=None, until=None):
+        if self.limiter is None:
+            return await self.download(url, headers, until)
+
+        # The limiter is shared by every stage so the load on a host does not depend on how many stages use it
+        host = urllib.parse.urlsplit(url).netloc
+        await self.limiter.acquire(host)
+
+        started, failed = time.monotonic(), True
+        try:
+            result = await self.download(url, headers, until)
+            failed = False
+            return result
+        except HttpError as ex:
+            if ex.retry_after:
+                self.limiter.pause(host, ex.retry_after)
+            raise
+        except (ServerError, NotFoundError):
+            failed = False
+            raise
+        finally:
+            self.limiter.release(host, time.monotonic() - started, failed)
+
+    async def download(self, url, headers=None, until=None):
+        logger.debug("Requesting %s", url)
+        self.requests += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.total_timeout if self.total_timeout else None
+
         try:
-            response = yield from aiohttp.request("GET", url, allow_redirects=True)
+            response = await asyncio.wait_for(
+                self.get_session().request("GET", url, headers=headers, allow_redirects=True),
+                self.remaining(deadline, self.first_byte_timeout)
+            )
+        except aiohttp.ServerTimeoutError as ex:
+            raise RequestTimeout(url, "connect") from ex
+        except asyncio.TimeoutError as ex:
+            phase = "total" if deadline and loop.time() >= deadline else "first_byte"
+            raise RequestTimeout(url, phase) from ex
         except Exception as e:
             logger.error("Could not retrieve {0}".format(url))
             raise
 
-        if 500 < response.status < 599:
-            raise HttpError(url, response.status)
-        elif response.status == 404:
-            raise NotFoundError(url)
+        try:
+            if response.status == 429 or 500 <= response.status < 600:
+                retry_after = response.headers.get("Retry-After", "")
+                raise HttpError(url, response.status, float(retry_after) if retry_after.isdigit() else None)
+            elif response.status == 404:
+                raise NotFoundError(url)
+            elif response.status == 304:
+                # Not modified is only an answer to a conditional request, which has no body to read
+                if headers and ("If-None-Match" in headers or "If-Modified-Since" in headers):
+                    return response, None
+                raise HttpError(url, response.status)
+
+            body = await self.read_body(url, response, deadline, until)
+        finally:
+            response.release()
 
-        data = yield from response.text()
+        data = body.decode(response.charset or "utf-8", errors="replace")
+        # The size of the body as it came over the network, not of the decoded text
+        response.body_size = len(body)
 
         if self.error_contents and self.error_contents in data:
-            raise ServerError(url)
+            raise ServerError(url, body=data)
 
         if self.not_found_contents and self.not_found_contents in data:
-            raise NotFoundError(url)
+            raise NotFoundError(url, body=data)
+
+        return response, data
+
+    @staticmethod
+    def remaining(deadline, timeout=None):
+        if deadline is None:
+            return timeout
+        left = max(0, deadline - asyncio.get_running_loop().time())
+        return left if timeout is None else min(left, timeout)
+
+    async def read_body(self, url, response, deadline, until=None):
+        # Reads the body in chunks, enforcing max_body_size and the total timeout while it streams in.
+        # until is a marker (str or bytes) or a callable given the body read so far; reading stops once the
+        # marker has been seen or the callable returns True.
+        if isinstance(until, str):
+            until = until.encode("utf-8")
+
+        body = bytearray()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(response.content.read(64 * 1024), self.remaining(deadline))
+            except asyncio.TimeoutError as ex:
+                response.close()
+                raise RequestTimeout(url, "total") from ex
+
+            if not chunk:
+                return body
+
+            body += chunk
+            self.bytes_downloaded += len(chunk)
+            if self.max_body_size and len(body) > self.max_body_size:
+                response.close()
+                raise BodyTooLargeError(url, "Body is larger than {0} bytes".format(self.max_body_size))
 
-        node = lxml.html.fromstring(data) #yield from asyncio.get_event_loop().run_in_executor(None, lxml.html.fromstring, data)
+            if until is None:
+                continue
+            elif callable(until):
+                stop = until(body)
+            else:
+                stop = body.find(until, max(0, len(body) - len(chunk) - len(until))) != -1
 
-        return Response(response, data, node)
\ No newline at end of file
+            if stop:
+                # The rest of the body is never read, so the connection cannot be reused
+                response.close()
+                return body
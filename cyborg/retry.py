@@ -0,0 +1,109 @@
+import aiohttp
+import asyncio
+import base64
+import json
+import logging
+import pickle
+import random
+import threading
+import time
+import traceback
+from .lib import BackgroundThread
+from .requester import ServerError, HttpError, RequestError, RequestTimeout
+
+logger = logging.getLogger("retry")
+
+
+class RetryPolicy(object):
+    RETRY_ON = (ServerError, HttpError, RequestTimeout, asyncio.TimeoutError, aiohttp.ClientError)
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=60.0, jitter=True, retry_on=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on) if retry_on is not None else self.RETRY_ON
+
+    def should_retry(self, exception, attempt):
+        return attempt < self.max_attempts and isinstance(exception, self.retry_on)
+
+    def delay(self, attempt):
+        # Exponential backoff with "full jitter", so retries of items that failed together are spread out
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+class DeadLetterQueue(object):
+    # Items that failed for good, stored one JSON object per line with the error, traceback and page body.
+    # replay() reads the items back so they can be fed into a pipeline again. Items that are not JSON are pickled.
+    # Records are written by a background thread, flush() waits until they are all on disk.
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.thread = BackgroundThread()
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.scheduled = False
+
+    def put(self, stage, item, attempts, exception):
+        record = {
+            "time": time.time(),
+            "stage": stage,
+            "item": item,
+            "tuple": isinstance(item, tuple),
+            "attempts": attempts,
+            "error": repr(exception),
+            "traceback": "".join(traceback.format_exception(type(exception), exception, exception.__traceback__)),
+            "url": exception.url if isinstance(exception, RequestError) else None,
+            "body": getattr(exception, "body", None)
+        }
+        try:
+            json.dumps(item)
+        except (TypeError, ValueError):
+            record["item"] = repr(item)
+            try:
+                record["pickle"] = base64.b64encode(pickle.dumps(item, pickle.HIGHEST_PROTOCOL)).decode("ascii")
+            except Exception:
+                logger.warning("Dead lettered item %r of %s cannot be replayed", item, stage)
+                record["pickle"] = None
+        # Encoded now, as the item can still change once it is dead lettered
+        line = json.dumps(record, default=repr) + "\n"
+        with self.lock:
+            self.buffer.append(line)
+            # Lines put while a write is waiting to start go with it
+            if not self.scheduled:
+                self.scheduled = True
+                self.thread.submit(self.write)
+        self.count += 1
+
+    def write(self):
+        with self.lock:
+            lines, self.buffer, self.scheduled = self.buffer, [], False
+        if lines:
+            with open(self.path, "a", encoding="utf-8") as fd:
+                fd.write("".join(lines))
+
+    async def flush(self):
+        if self.thread.started:
+            await self.thread.run(self.write)
+
+    def records(self, stage=None):
+        try:
+            with open(self.path, encoding="utf-8") as fd:
+                for line in fd:
+                    record = json.loads(line)
+                    if stage is None or record["stage"] == stage:
+                        yield record
+        except FileNotFoundError:
+            return
+
+    def replay(self, stage=None):
+        for record in self.records(stage):
+            if "pickle" in record:
+                if record["pickle"] is None:
+                    logger.warning("Skipping %s, it was not saved in a form that can be replayed", record["item"])
+                    continue
+                yield pickle.loads(base64.b64decode(record["pickle"]))
+            else:
+                yield tuple(record["item"]) if record["tuple"] else record["item"]
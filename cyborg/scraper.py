@@ -1,21 +1,35 @@
 import asyncio
-from .lib import QueueDone
+from .lib import QueueDone, Limit, Chunk, Retry
 from .page import Page
-from .requester import Requester, ServerError, NotFoundError, HttpError
+from .requester import Requester, Response, ServerError, NotFoundError, HttpError, DuplicateURLError, CacheMissError, \
+    RequestTimeout, BodyTooLargeError, PROCESS, body_size
 from .selector import SelectorException
+from .metrics import Histogram
 
 import logging
 import re
-from collections import defaultdict
-import traceback
+import time
+from collections import defaultdict, deque
 
 
 class BaseHandler(object):
     MAX_TASKS = 5
+    # Set to "html" or "json" to skip guessing the response type from its headers and body
+    EXPECTS = None
+    # Set to False for pages whose content changes between requests, like paginated APIs
+    DEDUP_URLS = True
+    # A RetryPolicy for items that fail, by default they are dropped
+    RETRY_POLICY = None
+    # Stop downloading a page once this marker has been read. It can also be a staticmethod that is given the
+    # bytes read so far and returns True to stop.
+    READ_UNTIL = None
+    # Set to True to skip parsing and scraping pages that have not changed since the previous run of an incremental
+    # pipeline, see Pipeline.incremental()
+    SKIP_UNCHANGED = False
 
     def __init__(self,
-                 input_queue: asyncio.JoinableQueue,
-                 output_queue: asyncio.JoinableQueue,
+                 input_queue: asyncio.Queue,
+                 output_queue: asyncio.Queue,
                  requester: Requester,
                  parent):
         self.input_queue = input_queue
@@ -23,6 +37,15 @@ class BaseHandler(object):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.requester = requester
         self.parent = parent
+        # A tracing.Tracer when the pipeline is traced
+        self.tracer = getattr(parent, "tracer", None)
+        # An incremental.ChangeTracker when the pipeline only outputs changes
+        self.changes = getattr(parent, "changes", None)
+        # Outputs are sent to the next stage in Chunks of up to chunk_size items, see Pipeline.chunks()
+        self.chunk_size = getattr(parent, "chunk_size", None) or 1
+        self.chunk_linger = getattr(parent, "chunk_linger", None)
+        # Whether whole chunks taken from the input queue are handled by run_chunk()
+        self.takes_chunks = False
 
         self.errors = defaultdict(int, {
             "server":0,
@@ -30,137 +53,535 @@ class BaseHandler(object):
             "exception":0
         })
         self.processed = 0
+        self.retry_policy = self.RETRY_POLICY
+        # Non-error figures like time spent parsing, shown next to the errors by the display plugin
+        self.stats = defaultdict(float)
+
+        # Time spent handling items, minus the time spent waiting on a full output queue
+        self.completed = 0
+        self.busy_time = 0.0
+        self.blocked_time = 0.0
+        # Latencies of handling items, fetching, parsing and scraping pages, read by PipelineMetrics
+        self.histograms = defaultdict(Histogram)
+        self.bytes_received = 0
+
+        # Items being handled by the workers, saved by pipeline checkpoints
+        self.in_flight = {}
+        self.sequence = 0
+        # The attempt and trace span of items put back on the input queue to be retried, by their Retry key
+        self.retrying = {}
+        self.timers = set()
+        # Items of chunks taken from the input queue that no worker has started yet, each with the number of items
+        # of its chunk left to finish
+        self.inbox = deque()
+        # Outputs waiting to be sent as a chunk, and chunks waiting for room on the output queue
+        self.outbox = []
+        self.outgoing = []
+        self.outbox_timer = None
+
+        # The stage's workers each take items from the input queue until the stage is stopped
+        self.size = self.MAX_TASKS
+        self.running = 0
+        self.pool = None
+        self.finished = None
+
+    @property
+    def workers(self):
+        return self.size
+
+    def set_workers(self, workers):
+        self.size = max(1, workers)
+        self.spawn()
+
+    def spawn(self):
+        # Workers beyond the size stop once they finish their current item
+        while self.pool is not None and self.running < self.size:
+            self.running += 1
+            self.pool.add(asyncio.create_task(self.worker()))
+
+    async def start(self):
+        self.finished = asyncio.Event()
+        self.pool = set()
+        self.spawn()
+        try:
+            await self.supervise(self.finished.wait())
+            self.logger.info("Queue done, waiting for items being handled")
+            await self.supervise(self.drain())
+        finally:
+            await self.stop()
 
-        self.task_semaphore = asyncio.BoundedSemaphore(self.MAX_TASKS)
-
-    @asyncio.coroutine
-    def start(self):
-        while True:
-            obj = yield from self.input_queue.get()
-
-            if obj is QueueDone:
-                self.logger.info("Queue done, waiting extra tasks")
-                self.input_queue.task_done()
-                yield from self.input_queue.join()
-
-                yield from self.complete()
-                yield from self.output(QueueDone)
-                self.logger.info("Task complete: {0} processed".format(self.processed))
+        await self.complete()
+        await self.output(QueueDone)
+        self.logger.info("Task complete: {0} processed".format(self.processed))
 
-                total_errors = sum(self.errors.values())
-                if total_errors:
-                    message = ", ".join("{0}: {1}".format(key, value)
-                                        for key, value in self.errors.items() if value > 0)
-                    self.logger.info("Errors: {0}".format(message))
+        total_errors = sum(self.errors.values())
+        if total_errors:
+            message = ", ".join("{0}: {1}".format(key, value) for key, value in self.errors.items() if value > 0)
+            self.logger.info("Errors: {0}".format(message))
 
-                break
+    async def supervise(self, awaitable):
+        # Waits for awaitable, raising the exception of any worker that fails in the meantime
+        task = asyncio.ensure_future(awaitable)
+        try:
+            while not task.done():
+                await asyncio.wait([task, *self.pool], return_when=asyncio.FIRST_COMPLETED)
+                for worker in [worker for worker in self.pool if worker.done()]:
+                    self.pool.discard(worker)
+                    worker.result()
+            return task.result()
+        finally:
+            task.cancel()
 
-            self.logger.info("Input: {0}".format(obj))
+    async def drain(self):
+        # Items waiting to be retried are not on the queue until their timer puts them back
+        while True:
+            await self.input_queue.join()
+            if not self.timers:
+                return
+            await asyncio.wait(list(self.timers))
+
+    async def stop(self):
+        tasks = list(self.pool) + list(self.timers)
+        self.pool = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def worker(self):
+        try:
+            # The pool is gone once the stage is stopped. Checked as well as being cancelled, because asyncio.wait_for()
+            # can swallow a cancellation that arrives just as what it waits for completes (fixed in Python 3.12).
+            while self.running <= self.size and self.pool is not None:
+                if self.outbox and not self.inbox and self.input_queue.empty():
+                    # Nothing else to do yet, so send what has been output rather than wait for a full chunk
+                    await self.flush_outbox()
+
+                if self.inbox:
+                    obj, left = self.inbox.popleft()
+                else:
+                    obj, left = await self.input_queue.get(), None
+                    if obj is QueueDone:
+                        # Items being retried can still be put back after QueueDone, so keep taking items until stopped
+                        self.input_queue.task_done()
+                        self.finished.set()
+                        continue
+                    if isinstance(obj, Chunk):
+                        if self.takes_chunks:
+                            await self.run_chunk(obj)
+                            self.input_queue.task_done()
+                            continue
+                        # Shared with the other workers, the chunk is done once all of its items are
+                        left = [len(obj)]
+                        self.inbox.extend((item, left) for item in obj[1:])
+                        obj = obj[0]
+
+                await self.run_single(obj)
+                if left is not None:
+                    left[0] -= 1
+                    if left[0]:
+                        continue
+                self.input_queue.task_done()
+        finally:
+            self.running -= 1
+
+    async def run_single(self, obj):
+        attempt, span = 1, None
+        if isinstance(obj, Retry):
+            attempt, span = self.retrying.pop(obj.key)
+            obj = obj.item
+        if attempt == 1:
+            self.logger.info("Input: %s", obj)
             self.processed += 1
-
-            yield from self.task_semaphore.acquire()
-            asyncio.async(self.run_single(obj)) # ToDo: don't use async as it's deprecated
-
-    @asyncio.coroutine
-    def run_single(self, obj):
+            if self.tracer is not None:
+                span = self.tracer.begin(self.__class__.__name__, obj)
+        if span is not None:
+            self.tracer.activate(span)
+
+        self.sequence += 1
+        key = self.sequence
+        self.in_flight[key] = obj
+        started = time.monotonic()
+        retrying, error = False, None
         try:
-            yield from self._handle_input(obj)
-        except ServerError:
+            await self._handle_input(obj)
+        except Exception as ex:
+            error = ex
+            retrying = self.retry_later(obj, key, attempt, span, ex)
+            if not retrying:
+                self.record_error(ex)
+                self.dead_letter(obj, attempt, ex)
+        finally:
+            if span is not None:
+                self.tracer.deactivate()
+                if not retrying:
+                    self.tracer.end(span, error)
+
+            self.completed += 1
+            elapsed = time.monotonic() - started
+            self.busy_time += elapsed
+            self.histograms["item"].observe(elapsed)
+
+            # An item waiting to be retried stays in flight until it is back on the input queue
+            if not retrying:
+                del self.in_flight[key]
+
+    def record_error(self, ex):
+        if isinstance(ex, ServerError):
             self.errors["server"] += 1
-        except NotFoundError:
+        elif isinstance(ex, NotFoundError):
             self.errors["notfound"] += 1
-        except HttpError as ex:
+        elif isinstance(ex, DuplicateURLError):
+            self.errors["duplicate_url"] += 1
+        elif isinstance(ex, CacheMissError):
+            self.errors["cache_miss"] += 1
+        elif isinstance(ex, RequestTimeout):
+            self.errors["timeout"] += 1
+        elif isinstance(ex, BodyTooLargeError):
+            self.errors["too_large"] += 1
+        elif isinstance(ex, HttpError):
             self.errors[ex.code] += 1
-        except SelectorException as e:
-            self.logger.exception("Selector {0} failed".format(e.selector))
-        except Exception as ex:
+        elif isinstance(ex, SelectorException):
+            self.logger.exception("Selector {0} failed".format(ex.selector))
+        else:
             self.errors["exception"] += 1
             self.logger.exception("Handle input raised exception")
-            #self.logger.exception(traceback.format_exc())
-        finally:
-            self.input_queue.task_done()
-            self.logger.debug("releasing " + str(self.task_semaphore))
-            self.task_semaphore.release()
 
-    @asyncio.coroutine
-    def complete(self):
+    def retry_later(self, obj, key, attempt, span, ex):
+        if self.retry_policy is None or not self.retry_policy.should_retry(ex, attempt):
+            return False
+
+        delay = self.retry_policy.delay(attempt)
+        self.errors["retries"] += 1
+        self.logger.info("Retrying %s in %.2fs after %r", obj, delay, ex)
+        if span is not None:
+            span.attempts += 1
+        self.start_timer(self.run_retry(obj, key, attempt + 1, span, delay))
+        return True
+
+    async def run_retry(self, obj, key, attempt, span, delay):
+        # The item does not hold a worker while it waits
+        await asyncio.sleep(delay)
+        self.retrying[key] = (attempt, span)
+        await self.input_queue.put(Retry(obj, key))
+        del self.in_flight[key]
+
+    def start_timer(self, coro):
+        # A background task of the stage, which is not finished until they are done
+        timer = asyncio.create_task(coro)
+        self.timers.add(timer)
+        timer.add_done_callback(self.timers.discard)
+
+    def dead_letter(self, obj, attempt, ex):
+        if isinstance(ex, (NotFoundError, DuplicateURLError)):
+            return
+        if self.changes is not None:
+            # Records the item would have led to were not seen, but may still exist
+            self.changes.item_failed()
+        dead_letters = getattr(self.parent, "dead_letter_queue", None)
+        if dead_letters is not None:
+            dead_letters.put(self.__class__.__name__, obj, attempt, ex)
+
+    async def complete(self):
         return
 
-    @asyncio.coroutine
-    def output(self, obj):
-        self.logger.info("Output: {0}".format(obj))
-        yield from self.output_queue.put(obj)
+    def checkpoint(self):
+        # Items in "requeue" are put back on this stage's input on resume, so interrupted work is redone.
+        # Items in "forward" are put on its output.
+        return {
+            "processed": self.processed,
+            "errors": dict(self.errors),
+            "stats": dict(self.stats),
+            "requeue": list(self.in_flight.values()) + self.unstarted(),
+            "forward": list(self.outbox) + [obj for chunk in self.outgoing for obj in chunk]
+        }
+
+    def unstarted(self):
+        return [obj for obj, _ in self.inbox]
+
+    def restore(self, state):
+        self.processed = state["processed"]
+        self.errors.update(state["errors"])
+        self.stats.update(state["stats"])
+
+    async def output(self, obj):
+        self.logger.info("Output: %s", obj)
+        if self.tracer is not None:
+            self.tracer.output(obj)
+        if obj is QueueDone:
+            await self.flush_outbox()
+        elif self.chunk_size > 1:
+            self.outbox.append(obj)
+            if len(self.outbox) >= self.chunk_size:
+                await self.flush_outbox()
+            elif self.outbox_timer is None and self.chunk_linger is not None:
+                self.outbox_timer = asyncio.get_running_loop().call_later(self.chunk_linger, self.outbox_expired)
+            return
+        await self.send(obj)
+
+    async def output_many(self, objs):
+        if self.chunk_size <= 1 or self.tracer is not None:
+            for obj in objs:
+                await self.output(obj)
+            return
+        if self.logger.isEnabledFor(logging.INFO):
+            for obj in objs:
+                self.logger.info("Output: %s", obj)
+        self.outbox.extend(objs)
+        while len(self.outbox) >= self.chunk_size:
+            await self.flush_outbox()
+        if self.outbox and self.outbox_timer is None and self.chunk_linger is not None:
+            self.outbox_timer = asyncio.get_running_loop().call_later(self.chunk_linger, self.outbox_expired)
+
+    def outbox_expired(self):
+        self.outbox_timer = None
+        self.start_timer(self.flush_outbox())
+
+    async def flush_outbox(self):
+        if self.outbox_timer is not None:
+            self.outbox_timer.cancel()
+            self.outbox_timer = None
+        if not self.outbox:
+            return
+        chunk, self.outbox = Chunk(self.outbox[:self.chunk_size]), self.outbox[self.chunk_size:]
+        self.outgoing.append(chunk)
+        await self.send(chunk)
+        self.outgoing.remove(chunk)
+
+    async def send(self, obj):
+        if self.output_queue.full():
+            started = time.monotonic()
+            await self.output_queue.put(obj)
+            self.blocked_time += time.monotonic() - started
+        else:
+            await self.output_queue.put(obj)
 
-    @asyncio.coroutine
-    def _handle_input(self, obj):
+    async def _handle_input(self, obj):
         raise NotImplementedError()
 
-    @asyncio.coroutine
-    def get(self, url):
-        return (yield from self.requester.get(url))
+    def observe(self, name, seconds):
+        self.histograms[name].observe(seconds)
+        if self.tracer is not None:
+            self.tracer.observe(name, seconds)
+
+    async def get(self, url):
+        response = await self.requester.get(url, expects=self.EXPECTS, dedup=self.DEDUP_URLS,
+                                                 until=self.READ_UNTIL)
+        self.observe("fetch", response.fetch_time)
+        self.bytes_received += body_size(response.response)
+        return response
 
     def trim_whitespace(self, text):
         return re.sub("\s+", " ", text)
 
 
 class Processor(BaseHandler):
-    @asyncio.coroutine
-    def _handle_input(self, obj):
+    # Set to True to have process_chunk() handle whole chunks of items instead of process() handling each one.
+    # Traced pipelines still handle items one at a time, so outputs keep the trace ids of their inputs.
+    PROCESS_CHUNKS = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.takes_chunks = self.PROCESS_CHUNKS and self.tracer is None
+
+    async def run_chunk(self, chunk):
+        self.sequence += 1
+        key = self.sequence
+        self.in_flight[key] = chunk
+        started = time.monotonic()
+        try:
+            results = await self.process_chunk([obj if isinstance(obj, tuple) else (obj, None) for obj in chunk])
+        except Exception:
+            # Handle the items again one at a time, so each is retried or dead lettered on its own
+            del self.in_flight[key]
+            for obj in chunk:
+                await self.run_single(obj)
+            return
+
+        outputs = []
+        for new_data in results:
+            if isinstance(new_data, list):
+                outputs.extend(new_data)
+            elif new_data is not None:
+                outputs.append(new_data)
+
+        if self.logger.isEnabledFor(logging.INFO):
+            for obj in chunk:
+                self.logger.info("Input: %s", obj)
+        self.processed += len(chunk)
+        self.completed += len(chunk)
+        elapsed = time.monotonic() - started
+        self.busy_time += elapsed
+        self.histograms["item"].observe(elapsed / len(chunk), len(chunk))
+        # The outputs are in the outbox before the chunk leaves in_flight, so checkpoints see each item once
+        del self.in_flight[key]
+        await self.output_many(outputs)
+
+    async def _handle_input(self, obj):
         if isinstance(obj, tuple):
             data, url = obj
         else:
             data, url = obj, None
 
-        new_data = yield from self.process(data, url)
+        new_data = await self.process(data, url)
 
-        yield from self.handle_response(new_data)
+        await self.handle_response(new_data)
 
-    @asyncio.coroutine
-    def handle_response(self, new_data):
+    async def handle_response(self, new_data):
         if new_data is not None:
             if isinstance(new_data, list):
                 for d, u in new_data:
-                    yield from self.output((d, u))
+                    await self.output((d, u))
             else:
-                yield from self.output(new_data)
+                await self.output(new_data)
 
-    @asyncio.coroutine
-    def process(self, data, url):
+    async def process(self, data, url):
+        raise NotImplementedError()
+
+    async def process_chunk(self, items):
+        # items is a list of (data, url) pairs, returns the results process() would return for them. If it raises
+        # before any side effect, like adding a key to a store, the items are safely handled again by process().
         raise NotImplementedError()
 
 
 class BatchProcessor(Processor):
+    # Collects items into batches that are handled with a single request. process_batch() returns the URL for a
+    # batch and process_response() yields its results in order. Up to MAX_BATCHES requests are in flight at once, and
+    # a partial batch is sent once its first item has waited MAX_LINGER seconds.
+    #
+    # With a LATENCY_TARGET in seconds the batch size adapts between MIN_BATCH_SIZE and MAX_BATCH_SIZE: it grows by one
+    # after full batches that return faster than the target, and shrinks when they are slower or fail.
     BATCH_SIZE = 10
     MAX_TASKS = 1
+    MAX_BATCHES = 4
+    MAX_LINGER = 1.0
+    LATENCY_TARGET = None
+    MIN_BATCH_SIZE = 1
+    MAX_BATCH_SIZE = 100
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.bucket = []
-
-    @asyncio.coroutine
-    def process(self, data, url):
+        self.batch_size = self.BATCH_SIZE
+        self.last_shrink = 0.0
+        self.batch_slots = Limit(self.MAX_BATCHES)
+        self.linger = None
+        # Batches being sent and their tasks, by sequence number
+        self.batches = {}
+        self.senders = {}
+        self.batch_sequence = 0
+
+    async def process(self, data, url):
         self.bucket.append((data, url))
-        if len(self.bucket) > self.BATCH_SIZE:
-            returner = yield from self.flush()
-            return returner
-        else:
-            return None
+        if len(self.bucket) >= self.batch_size:
+            await self.flush()
+        elif self.linger is None and self.MAX_LINGER is not None:
+            self.linger = asyncio.get_running_loop().call_later(self.MAX_LINGER, self.linger_expired)
+        return None
 
-    @asyncio.coroutine
-    def flush(self):
-        if not self.bucket:
-            return []
+    def linger_expired(self):
+        self.linger = None
+        self.start_timer(self.flush())
 
-        url = self.process_batch(self.bucket)
-        response = yield from self.get(url)
-        returner = [d for d in self.process_response(self.bucket, response)]
-        self.bucket = []
-        return returner
-
-    @asyncio.coroutine
-    def complete(self):
-        response = yield from self.flush()
-        yield from self.handle_response(response)
+    async def start(self):
+        try:
+            await super().start()
+        finally:
+            # complete() waits for every batch, so batches are only left here when the stage was cancelled
+            senders = list(self.senders.values())
+            for sender in senders:
+                sender.cancel()
+            await asyncio.gather(*senders, return_exceptions=True)
+
+    async def flush(self):
+        # Waits for a free slot, so a worker filling batches faster than they are sent is held back
+        await self.batch_slots.acquire()
+        if not self.bucket:
+            self.batch_slots.release()
+            return
+
+        batch, self.bucket = self.bucket[:self.batch_size], self.bucket[self.batch_size:]
+        if self.linger is not None:
+            self.linger.cancel()
+            self.linger = None
+        if self.bucket and self.MAX_LINGER is not None:
+            self.linger = asyncio.get_running_loop().call_later(self.MAX_LINGER, self.linger_expired)
+
+        self.batch_sequence += 1
+        self.batches[self.batch_sequence] = batch
+        self.senders[self.batch_sequence] = asyncio.create_task(self.send_batch(self.batch_sequence, batch))
+
+    async def send_batch(self, key, batch):
+        attempt, holding_slot = 1, True
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    url = self.process_batch(batch)
+                    response = await self.get(url)
+                    results = list(self.process_response(batch, response))
+                except Exception as ex:
+                    self.adapt(len(batch), None)
+                    if self.retry_policy is None or not self.retry_policy.should_retry(ex, attempt):
+                        self.record_error(ex)
+                        for obj in batch:
+                            self.dead_letter(obj, attempt, ex)
+                        return
+                    self.errors["retries"] += 1
+                    # Other batches can be sent while this one waits to be retried
+                    self.batch_slots.release()
+                    holding_slot = False
+                    await asyncio.sleep(self.retry_policy.delay(attempt))
+                    await self.batch_slots.acquire()
+                    holding_slot = True
+                    attempt += 1
+                    continue
+
+                elapsed = time.monotonic() - started
+                self.observe("batch", elapsed)
+                self.adapt(len(batch), elapsed)
+                try:
+                    await self.handle_response(results)
+                except Exception as ex:
+                    # Part of the results may have been output already, so the batch is not retried
+                    self.record_error(ex)
+                    for obj in batch:
+                        self.dead_letter(obj, attempt, ex)
+                return
+        finally:
+            del self.batches[key]
+            del self.senders[key]
+            if holding_slot:
+                self.batch_slots.release()
+
+    def adapt(self, size, latency):
+        if self.LATENCY_TARGET is None:
+            return
+        if latency is not None and latency <= self.LATENCY_TARGET:
+            if size >= self.batch_size:
+                self.batch_size = min(self.MAX_BATCH_SIZE, self.batch_size + 1)
+        else:
+            # Batches sent together fail or slow down together, so only shrink once per round trip
+            now = time.monotonic()
+            if now - self.last_shrink > (latency or self.LATENCY_TARGET):
+                self.last_shrink = now
+                self.batch_size = max(self.MIN_BATCH_SIZE, self.batch_size * 3 // 4)
+        self.stats["batch_size"] = self.batch_size
+
+    async def complete(self):
+        if self.linger is not None:
+            self.linger.cancel()
+            self.linger = None
+        while self.bucket:
+            await self.flush()
+        while self.senders:
+            await asyncio.wait(list(self.senders.values()))
+
+    def checkpoint(self):
+        # Every item handed to process() is in the bucket or a batch being sent until its batch has been output
+        state = super().checkpoint()
+        state["requeue"] = list(self.bucket) + [obj for batch in self.batches.values() for obj in batch] + \
+            self.unstarted()
+        return state
 
     def process_batch(self, batch):
         raise NotImplementedError()
@@ -171,6 +592,11 @@ class BatchProcessor(Processor):
 
 class Scraper(BaseHandler):
     page_format = Page("{input}")
+    # A cyborg.extract.Schema used by the default scrape(), its records are merged into the incoming data
+    SCHEMA = None
+    # Set to True when scrape() reads the HTML document, so the "thread" parser parses pages in its thread pool
+    # before scrape() runs. Otherwise pages are parsed on first access to response.document.
+    PARSE_DOCUMENT = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -179,18 +605,106 @@ class Scraper(BaseHandler):
     def set_host(self, host):
         self.page.set_host(host)
 
-    @asyncio.coroutine
-    def _handle_input(self, obj):
+    async def _handle_input(self, obj):
         if isinstance(obj, tuple):
             data, url = obj[0], self.page.get_url(obj[1])
         else:
             data, url = {}, self.page.get_url(obj)
+        if self.tracer is not None:
+            self.tracer.set_url(url)
 
-        response = yield from self.get(url)
-
-        for val in self.scrape(data, response):
-            new_data, next_url = val
-            yield from self.output((new_data, next_url))
+        changes = self.changes if self.SKIP_UNCHANGED else None
+        if changes is None:
+            await self.handle_page(data, url, None)
+            return
+        try:
+            await self.handle_page(data, url, changes)
+        except NotFoundError:
+            raise
+        except Exception:
+            # The records of a page that could not be handled this time are not reported as deleted
+            await changes.keep_page(url)
+            raise
+
+    async def handle_page(self, data, url, changes):
+        if self.requester.parser == PROCESS:
+            # Parse and scrape in a worker process, only the extracted data is sent back
+            started = time.perf_counter()
+            response, content = await self.requester.fetch(url, self.DEDUP_URLS, self.READ_UNTIL)
+            self.observe("fetch", time.perf_counter() - started)
+            self.bytes_received += body_size(response)
+            if changes is not None:
+                digest = changes.page_digest(content)
+                if await changes.skip_page(url, digest):
+                    self.stats["unchanged_pages"] += 1
+                    return
+            try:
+                results, parse_time, scrape_time = await self.requester.run_detached(
+                    scrape_detached, type(self), data, content, list(response.headers.items())
+                )
+            except Exception as ex:
+                ex.body = content
+                raise
+            await self.output_all(results)
+            if changes is not None:
+                changes.record_page(url, digest, [new_data for new_data, _ in results])
+        else:
+            response = await self.get(url)
+            content = response.body
+            if changes is not None:
+                digest, scraped = changes.page_digest(content), []
+                if await changes.skip_page(url, digest):
+                    self.stats["unchanged_pages"] += 1
+                    return
+            if self.PARSE_DOCUMENT or self.SCHEMA is not None:
+                await self.requester.parse(response)
+            # scrape() is timed separately from waiting on the next stage. Any parsing done while
+            # scraping is counted as parse time, as responses are parsed lazily.
+            parsed_before = response.parse_time
+            results, scrape_time = iter(self.scrape(data, response)), 0.0
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        val = next(results)
+                    finally:
+                        scrape_time += time.perf_counter() - started
+                    await self.output(val)
+                    if changes is not None:
+                        scraped.append(val[0] if isinstance(val, tuple) else val)
+            except StopIteration:
+                pass
+            except Exception as ex:
+                # Keep the page that broke scrape() for the dead letter queue
+                if getattr(ex, "body", None) is None:
+                    ex.body = content
+                raise
+            if changes is not None:
+                changes.record_page(url, digest, scraped)
+            parse_time = response.parse_time
+            # Only parsing done lazily inside scrape() was timed as part of it
+            scrape_time -= parse_time - parsed_before
+
+        self.stats["parse_time"] += parse_time
+        self.observe("parse", parse_time)
+        self.observe("scrape", scrape_time)
+
+    async def output_all(self, results):
+        for new_data, next_url in results:
+            await self.output((new_data, next_url))
 
     def scrape(self, data, response):
-        raise NotImplementedError()
\ No newline at end of file
+        if self.SCHEMA is None:
+            raise NotImplementedError()
+        for record, url in self.SCHEMA.extract(response.document):
+            new_data = dict(data)
+            new_data.update(record)
+            yield new_data, url
+
+
+def scrape_detached(scraper_cls, data, content, headers):
+    scraper = scraper_cls(None, None, None, None)
+    response = Response(None, content, scraper.EXPECTS, headers=headers)
+    started = time.perf_counter()
+    results = list(scraper.scrape(data, response))
+    return results, response.parse_time, time.perf_counter() - started - response.parse_time
\ No newline at end of file
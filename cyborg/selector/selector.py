@@ -1,46 +1,74 @@
 import logging
 from cssselect import HTMLTranslator, SelectorError
 from functools import lru_cache
+from lxml import etree
 
 
 class SelectorException(RuntimeError):
     def __init__(self, selector):
         self.selector = selector
+        super().__init__(selector)
 
 translator = HTMLTranslator()
 
-@lru_cache()
+@lru_cache(maxsize=4096)
 def xpath(pattern):
     return translator.css_to_xpath(pattern)
 
+# Compiled once per pattern, so lxml does not parse the XPath expression on every call
+@lru_cache(maxsize=4096)
+def compiled(pattern):
+    return etree.XPath(xpath(pattern))
+
+@lru_cache(maxsize=4096)
+def compiled_attr(pattern, name):
+    return etree.XPath("({0})/@{1}".format(xpath(pattern), name))
+
 logger = logging.getLogger("selector")
 
 class Selector(object):
+    __slots__ = ("document", "_attr", "_classes")
+
     def __init__(self, document):
         self.document = document
-        self.translator = HTMLTranslator()
+        self._attr = None
+        self._classes = None
 
     def find(self, pattern):
-        expression = xpath(pattern)
-        results = [Selector(d) for d in self.document.xpath(expression)]
+        results = [Selector(d) for d in compiled(pattern)(self.document)]
         if len(results) == 0:
             logger.warning("Selector {0} found 0 results".format(pattern))
         return results
 
     def get(self, pattern):
-        expression = xpath(pattern)
-        results = self.document.xpath(expression)
+        results = compiled(pattern)(self.document)
         try:
             return Selector(results[0])
         except IndexError as e:
             raise SelectorException(pattern) from e
 
+    def texts(self, pattern):
+        # The text of every match, without wrapping each of them in a Selector
+        return [node.text_content() for node in compiled(pattern)(self.document)]
+
+    def attrs(self, pattern, name):
+        # The value of an attribute for every match that has it, in a single XPath evaluation
+        return [str(value) for value in compiled_attr(pattern, name)(self.document)]
+
     def has_class(self, cls):
-        return cls in self.attr.get("class", "").split(" ")
+        return cls in self.classes
+
+    @property
+    def classes(self):
+        if self._classes is None:
+            self._classes = frozenset(self.attr.get("class", "").split())
+        return self._classes
 
     @property
     def attr(self):
-        return dict(self.document.items())
+        if self._attr is None:
+            self._attr = dict(self.document.items())
+        return self._attr
 
     @property
     def text(self):
@@ -48,4 +76,4 @@ class Selector(object):
 
     @property
     def parent(self):
-        return Selector(self.document.getparent())
\ No newline at end of file
+        return Selector(self.document.getparent())
@@ -0,0 +1,260 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import sqlite3
+from .lib import BackgroundThread
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger("sinks")
+
+
+class Sink(object):
+    # Collects the pipeline's output into batches that are written by a single background thread. While a batch is
+    # being written put() waits for it, so a slow sink fills the pipeline's last queue instead of buffering without
+    # bound. Subclasses implement open(), write(items) and close(), which all run in that thread.
+    # Sinks are given each item's data, or the whole (data, url) pair when WHOLE_ITEMS is set.
+    WHOLE_ITEMS = False
+
+    def __init__(self, batch_size=1000, flush_interval=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.thread = BackgroundThread()
+        self.buffer = []
+        self.writing = []
+        self.written = 0
+        self.lock = None
+        self.flusher = None
+
+    def open(self):
+        return
+
+    def write(self, items):
+        raise NotImplementedError()
+
+    def close(self):
+        return
+
+    def pending(self):
+        # Items that were output but may not be on disk yet, saved by pipeline checkpoints
+        return self.writing + self.buffer
+
+    async def start(self):
+        self.lock = asyncio.Lock()
+        self.buffer, self.writing, self.written = [], [], 0
+        await self.thread.run(self.open)
+        if self.flush_interval:
+            self.flusher = asyncio.create_task(self.flush_periodically())
+
+    async def put(self, item):
+        self.buffer.append(item)
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.buffer:
+                return
+            self.writing, self.buffer = self.buffer, []
+            await self.thread.run(self.write, self.writing)
+            self.written += len(self.writing)
+            self.writing = []
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Cancelling a write that has not started yet would drop its batch, so the flush is shielded from
+            # finish() cancelling this task
+            await asyncio.shield(self.flush())
+
+    async def finish(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+        await self.flush()
+        await self.thread.run(self.close)
+        self.thread.shutdown()
+        logger.info("{0} wrote {1} items".format(self.__class__.__name__, self.written))
+
+    def abort(self):
+        # Used when the pipeline fails: write what was buffered without the event loop
+        if not self.thread.started:
+            return
+        if self.flusher is not None:
+            self.flusher.cancel()
+        self.thread.shutdown(wait=True)
+        self.writing = []
+        try:
+            if self.buffer:
+                self.write(self.buffer)
+                self.written += len(self.buffer)
+                self.buffer = []
+        finally:
+            self.close()
+
+
+class FileSink(Sink):
+    # Writes text to path, compressed with "gzip" or "zstd". With rotate_bytes a new numbered file
+    # (results-00001.jsonl.gz, ...) is started once the current one is that many bytes on disk, after compression.
+    # Use append=True when resuming a pipeline from a checkpoint.
+
+    def __init__(self, path, compression=None, rotate_bytes=None, append=False, **kwargs):
+        super().__init__(**kwargs)
+        if compression not in (None, "gzip", "zstd"):
+            raise ValueError("Unknown compression {0}".format(compression))
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("zstd compression needs the zstandard package")
+
+        self.path = path
+        self.compression = compression
+        self.rotate_bytes = rotate_bytes
+        self.mode = "at" if append else "wt"
+        self.fd = None
+        self.file_index = 0
+        self.file_bytes = 0
+        self.current_path = None
+
+    def file_path(self):
+        if not self.rotate_bytes:
+            return self.path
+        directory, name = os.path.split(self.path)
+        root, dot, ext = name.partition(".")
+        return os.path.join(directory, "{0}-{1:05d}{2}{3}".format(root, self.file_index, dot, ext))
+
+    def open_file(self):
+        path = self.file_path()
+        # A file being appended to already has its header
+        self.file_bytes = os.path.getsize(path) if self.mode == "at" and os.path.exists(path) else 0
+        if self.compression == "gzip":
+            self.fd = gzip.open(path, self.mode, encoding="utf-8")
+        elif self.compression == "zstd":
+            self.fd = zstandard.open(path, self.mode, encoding="utf-8")
+        else:
+            self.fd = open(path, self.mode, encoding="utf-8")
+        self.current_path = path
+        logger.info("Writing to {0}".format(path))
+
+    def header(self):
+        return ""
+
+    def encode(self, items):
+        raise NotImplementedError()
+
+    def write(self, items):
+        if self.fd is not None and self.rotate_bytes and self.file_bytes >= self.rotate_bytes:
+            self.fd.close()
+            self.fd = None
+            self.file_index += 1
+
+        text = self.encode(items)
+        if self.fd is None:
+            self.open_file()
+            if not self.file_bytes:
+                text = self.header() + text
+        self.fd.write(text)
+        self.fd.flush()
+        self.file_bytes = os.path.getsize(self.current_path)
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+
+class JsonLinesSink(FileSink):
+    def encode(self, items):
+        return "".join(json.dumps(item) + "\n" for item in items)
+
+
+class CsvSink(FileSink):
+    # Columns are taken from the first item unless given, keys missing from an item are left empty
+
+    def __init__(self, path, columns=None, **kwargs):
+        super().__init__(path, **kwargs)
+        self.columns = columns
+
+    def header(self):
+        return self.encode([dict(zip(self.columns, self.columns))])
+
+    def encode(self, items):
+        if self.columns is None:
+            self.columns = list(items[0])
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, self.columns, extrasaction="ignore")
+        for item in items:
+            writer.writerow({k: json.dumps(v) if isinstance(v, (list, dict)) else v for k, v in item.items()})
+        return buf.getvalue()
+
+
+class SqliteSink(Sink):
+    # Inserts each batch in a single transaction. The table is created from the first item's keys if it does not
+    # exist, lists and dicts are stored as JSON.
+
+    def __init__(self, path, table="items", columns=None, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.table = table
+        self.columns = columns
+        self.db = None
+
+    def open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+
+    def write(self, items):
+        if self.columns is None:
+            self.columns = list(items[0])
+
+        names = ", ".join('"{0}"'.format(column) for column in self.columns)
+        self.db.execute('CREATE TABLE IF NOT EXISTS "{0}" ({1})'.format(self.table, names))
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(self.table, names, ", ".join("?" * len(self.columns))),
+                ([self.value(item.get(column)) for column in self.columns] for item in items)
+            )
+
+    def value(self, value):
+        if isinstance(value, (list, dict)):
+            return json.dumps(value)
+        return value
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class ParquetSink(Sink):
+    # Every batch is written as a row group, the schema is inferred from the first batch
+
+    def __init__(self, path, compression="snappy", batch_size=10000, **kwargs):
+        if pyarrow is None:
+            raise ImportError("ParquetSink needs the pyarrow package")
+        super().__init__(batch_size=batch_size, **kwargs)
+        self.path = path
+        self.compression = compression
+        self.writer = None
+
+    def write(self, items):
+        if self.writer is None:
+            table = pyarrow.Table.from_pylist(items)
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema, compression=self.compression)
+        else:
+            table = pyarrow.Table.from_pylist(items, schema=self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
@@ -0,0 +1,227 @@
+import asyncio
+import glob
+import gzip
+import logging
+import os
+import sqlite3
+from .lib import BackgroundThread
+
+logger = logging.getLogger("sources")
+
+
+class Source(object):
+    # Input for Pipeline.feed() that is read in batches. Blocking reads run on a single background thread, and the
+    # next batch is only read once the previous one has been put on the pipeline's input queue.
+
+    def __init__(self):
+        self.thread = BackgroundThread()
+        self.items_read = 0
+
+    async def open(self):
+        return
+
+    async def next_batch(self):
+        # Returns a list of items, or None once the input is exhausted
+        raise NotImplementedError()
+
+    async def close(self):
+        self.thread.shutdown()
+
+    def progress(self):
+        # "fraction" is how far through the input the pipeline is, when that is known
+        return {"items": self.items_read}
+
+
+class AsyncIterableSource(Source):
+    def __init__(self, iterable):
+        super().__init__()
+        self.iterator = iterable.__aiter__()
+
+    async def next_batch(self):
+        # One item at a time, so a slow iterator is not held up waiting for a full batch
+        try:
+            batch = [(await self.iterator.__anext__())]
+        except StopAsyncIteration:
+            return None
+        self.items_read += 1
+        return batch
+
+
+class FileSource(Source):
+    # Yields the lines of a file, read in chunks of chunk_size bytes. Files ending in .gz are decompressed.
+    # parse is called on every line, for example json.loads. Blank lines are skipped.
+
+    def __init__(self, path, parse=None, chunk_size=1024 * 1024, encoding="utf-8", compression=None):
+        super().__init__()
+        self.path = path
+        self.parse = parse
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.compression = compression or ("gzip" if path.endswith(".gz") else None)
+        self.raw = None
+        self.fd = None
+        self.size = 0
+        self.position = 0
+        self.remainder = b""
+
+    def open_file(self):
+        self.raw = open(self.path, "rb")
+        self.size = os.fstat(self.raw.fileno()).st_size
+        self.fd = gzip.GzipFile(fileobj=self.raw) if self.compression == "gzip" else self.raw
+
+    async def open(self):
+        await self.thread.run(self.open_file)
+
+    def read_lines(self):
+        chunk = self.fd.read(self.chunk_size)
+        # The position in the compressed file for gzip
+        self.position = self.raw.tell()
+        if not chunk:
+            lines, self.remainder = [self.remainder], b""
+            return lines if lines[0].strip() else None
+        lines = (self.remainder + chunk).split(b"\n")
+        self.remainder = lines.pop()
+        return lines
+
+    async def next_batch(self):
+        while True:
+            lines = await self.thread.run(self.read_lines)
+            if lines is None:
+                return None
+
+            batch = [line.decode(self.encoding).rstrip("\r") for line in lines if line.strip()]
+            if self.parse is not None:
+                batch = [self.parse(line) for line in batch]
+            if batch:
+                self.items_read += len(batch)
+                return batch
+
+    def close_file(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.raw.close()
+            self.fd = self.raw = None
+
+    async def close(self):
+        await self.thread.run(self.close_file)
+        await super().close()
+
+    def progress(self):
+        progress = super().progress()
+        if self.size:
+            progress["fraction"] = self.position / self.size
+        return progress
+
+
+class SqliteSource(Source):
+    # Yields the rows of a query as dicts, page_size rows at a time
+
+    def __init__(self, path, query, params=(), page_size=1000):
+        super().__init__()
+        self.path = path
+        self.query = query
+        self.params = params
+        self.page_size = page_size
+        self.db = None
+        self.cursor = None
+        self.total = None
+
+    def open_query(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.total = self.db.execute("SELECT COUNT(*) FROM ({0})".format(self.query), self.params).fetchone()[0]
+        self.cursor = self.db.execute(self.query, self.params)
+
+    async def open(self):
+        await self.thread.run(self.open_query)
+
+    def fetch_page(self):
+        return [dict(row) for row in self.cursor.fetchmany(self.page_size)]
+
+    async def next_batch(self):
+        rows = await self.thread.run(self.fetch_page)
+        if not rows:
+            return None
+        self.items_read += len(rows)
+        return rows
+
+    async def close(self):
+        if self.db is not None:
+            await self.thread.run(self.db.close)
+            self.db = None
+        await super().close()
+
+    def progress(self):
+        progress = super().progress()
+        if self.total:
+            progress["fraction"] = self.items_read / self.total
+        return progress
+
+
+class DirectoryTail(Source):
+    # Follows the files matching pattern in a directory, yielding lines as they are appended and picking up new
+    # files, like "tail -f". It never finishes by itself, for crawls that keep receiving work.
+
+    def __init__(self, path, pattern="*", parse=None, interval=1.0, encoding="utf-8", from_start=True,
+                 chunk_size=1024 * 1024):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self.path = path
+        self.pattern = pattern
+        self.parse = parse
+        self.interval = interval
+        self.encoding = encoding
+        self.from_start = from_start
+        # The offset of the next unread line of every file seen
+        self.offsets = {}
+
+    def scan(self):
+        lines = []
+        for name in sorted(glob.glob(os.path.join(self.path, self.pattern))):
+            if not os.path.isfile(name):
+                continue
+            size = os.path.getsize(name)
+            if name not in self.offsets:
+                self.offsets[name] = 0 if self.from_start else size
+            if size < self.offsets[name]:
+                logger.info("{0} was truncated, reading it from the start".format(name))
+                self.offsets[name] = 0
+            if size == self.offsets[name]:
+                continue
+
+            with open(name, "rb") as fd:
+                fd.seek(self.offsets[name])
+                data = fd.read(min(size - self.offsets[name], self.chunk_size))
+                # A line longer than chunk_size is read on until its end
+                piece = data
+                while piece and b"\n" not in piece:
+                    piece = fd.read(min(size - self.offsets[name] - len(data), self.chunk_size))
+                    data += piece
+            # A line is only complete once its newline has been written
+            end = data.rfind(b"\n") + 1
+            self.offsets[name] += end
+            lines.extend(line for line in data[:end].split(b"\n") if line.strip())
+
+        self.from_start = True
+        return lines
+
+    async def open(self):
+        # Files already in the directory are skipped when not reading from the start
+        if not self.from_start:
+            await self.thread.run(self.scan)
+
+    async def next_batch(self):
+        while True:
+            lines = await self.thread.run(self.scan)
+            if lines:
+                batch = [line.decode(self.encoding).rstrip("\r") for line in lines]
+                if self.parse is not None:
+                    batch = [self.parse(line) for line in batch]
+                self.items_read += len(batch)
+                return batch
+            await asyncio.sleep(self.interval)
+
+    def progress(self):
+        progress = super().progress()
+        progress["files"] = len(self.offsets)
+        return progress
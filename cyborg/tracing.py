@@ -0,0 +1,263 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import random
+import signal
+import sys
+import threading
+import time
+from collections import defaultdict
+from .scraper import BaseHandler
+
+logger = logging.getLogger("tracing")
+
+
+def describe(obj):
+    # The URL of (data, url) items, otherwise the item itself
+    value = obj[1] if isinstance(obj, tuple) and len(obj) == 2 else obj
+    return str(value)[:200]
+
+
+class Span(object):
+    # The time one item spent in one stage. Timings are added by BaseHandler.observe() while it is handled,
+    # like fetch, parse and scrape for scrapers.
+    __slots__ = ("trace", "stage", "url", "enqueued", "started", "timings", "attempts", "children")
+
+    def __init__(self, trace, stage, url, enqueued):
+        self.trace = trace
+        self.stage = stage
+        self.url = url
+        self.enqueued = enqueued
+        self.started = time.monotonic()
+        self.timings = defaultdict(float)
+        self.attempts = 1
+        self.children = 0
+
+
+class Tracer(object):
+    # Follows items through the stages of a pipeline. Items taken from the pipeline's input get a trace id like
+    # "12", and items output while handling it get "12.1", "12.2" and so on, so an item's id names every item it
+    # came from. A span for every item and stage is written to path as a JSON line, followed by the slowest items
+    # of every stage and, with profile=True, the CPU time used by every handler class.
+    #
+    # sample is the fraction of input items traced. Spans shorter than threshold seconds are left out of the file
+    # but still count towards the slowest items.
+
+    def __init__(self, path, sample=1.0, threshold=0.0, top=10, profile=False, interval=0.005):
+        self.path = path
+        self.sample = sample
+        self.threshold = threshold
+        self.top = top
+        self.profiler = Profiler(interval) if profile else None
+        self.fd = None
+        self.roots = itertools.count(1)
+        self.spans = 0
+        # Trace ids and output times of items waiting for the next stage, by id() of the item
+        self.pending = {}
+        # The span of the item each task is handling
+        self.active = {}
+        # Min-heaps of (duration, trace, url) holding the slowest items of each stage
+        self.slowest = defaultdict(list)
+
+    @property
+    def running(self):
+        return self.fd is not None
+
+    def open(self):
+        self.fd = open(self.path, "w", encoding="utf-8")
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+        for stage, slowest in self.slowest.items():
+            self.write({
+                "type": "slowest",
+                "stage": stage,
+                "items": [{"trace": trace, "url": url, "duration": round(duration, 6)}
+                          for duration, trace, url in sorted(slowest, reverse=True)]
+            })
+        if self.profiler is not None:
+            self.write(dict(type="profile", **self.profiler.report()))
+        self.fd.close()
+        self.fd = None
+        self.pending.clear()
+        logger.info("Traced {0} spans to {1}".format(self.spans, self.path))
+
+    def write(self, record):
+        self.fd.write(json.dumps(record, default=repr) + "\n")
+
+    def begin(self, stage, obj):
+        entries = self.pending.get(id(obj))
+        if entries:
+            trace, enqueued = entries.pop(0)
+            if not entries:
+                del self.pending[id(obj)]
+        elif self.sample < 1 and random.random() >= self.sample:
+            return None
+        else:
+            trace, enqueued = str(next(self.roots)), None
+        return Span(trace, stage, describe(obj), enqueued)
+
+    def activate(self, span):
+        if span is not None:
+            self.active[asyncio.current_task()] = span
+
+    def deactivate(self):
+        self.active.pop(asyncio.current_task(), None)
+
+    def current(self):
+        return self.active.get(asyncio.current_task())
+
+    def observe(self, name, seconds):
+        span = self.current()
+        if span is not None:
+            span.timings[name] += seconds
+
+    def set_url(self, url):
+        span = self.current()
+        if span is not None:
+            span.url = url
+
+    def output(self, obj):
+        # Called before a handler puts an item on its output queue
+        span = self.current()
+        if span is None:
+            return
+        span.children += 1
+        trace = "{0}.{1}".format(span.trace, span.children)
+        self.pending.setdefault(id(obj), []).append((trace, time.monotonic()))
+
+    def discard(self, obj):
+        # The item left the pipeline
+        self.pending.pop(id(obj), None)
+
+    def end(self, span, error=None):
+        now = time.monotonic()
+        duration = now - span.started
+
+        slowest = self.slowest[span.stage]
+        heapq.heappush(slowest, (duration, span.trace, span.url))
+        if len(slowest) > self.top:
+            heapq.heappop(slowest)
+
+        if duration < self.threshold or self.fd is None:
+            return
+        self.spans += 1
+        record = {
+            "type": "span",
+            "trace": span.trace,
+            "stage": span.stage,
+            "url": span.url,
+            "start": round(time.time() - duration, 6),
+            "duration": round(duration, 6),
+            "queue_wait": None if span.enqueued is None else round(span.started - span.enqueued, 6),
+            "attempts": span.attempts,
+            "outputs": span.children,
+            "error": None if error is None else repr(error)
+        }
+        record.update((name, round(value, 6)) for name, value in span.timings.items())
+        self.write(record)
+
+
+class Profiler(object):
+    # Samples the stack of the main thread every interval seconds of CPU time, using SIGPROF, and counts the
+    # samples by the handler whose code was running. Code outside any handler, like the event loop and the
+    # requester, is counted as "other". Work done in parser threads or processes is not seen.
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self.total = 0
+        self.previous = None
+        self.started = False
+
+    def start(self):
+        if not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+            logger.warning("The profiler needs SIGPROF and must be started from the main thread, it is disabled")
+            return
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.started = True
+
+    def stop(self):
+        if self.started:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+            self.started = False
+
+    def sample(self, signum, frame):
+        self.total += 1
+        # The innermost frame of a handler method
+        while frame is not None:
+            code = frame.f_code
+            if code.co_argcount and code.co_varnames[0] == "self":
+                handler = frame.f_locals.get("self")
+                if isinstance(handler, BaseHandler):
+                    self.samples[(handler.__class__.__name__, code.co_name)] += 1
+                    return
+            frame = frame.f_back
+        self.samples[("other", "")] += 1
+
+    def report(self):
+        seconds, functions = defaultdict(float), {}
+        for (name, function), count in self.samples.items():
+            seconds[name] += count * self.interval
+            if function:
+                functions["{0}.{1}".format(name, function)] = round(count * self.interval, 3)
+        return {
+            "interval": self.interval,
+            "samples": self.total,
+            "seconds": {name: round(value, 3) for name, value in seconds.items()},
+            "functions": functions
+        }
+
+
+def quantile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)] if values else None
+
+
+def summarize(path, out=sys.stdout):
+    # Prints the latency of every stage, its slowest items and the profile from a trace file:
+    #
+    #     python -c 'from cyborg.tracing import summarize; summarize("trace.jsonl")'
+    timings, slowest, profile = defaultdict(lambda: defaultdict(list)), {}, None
+    with open(path, encoding="utf-8") as fd:
+        for line in fd:
+            record = json.loads(line)
+            if record["type"] == "span":
+                stage = timings[record["stage"]]
+                for name in ("duration", "queue_wait", "fetch", "parse", "scrape"):
+                    if record.get(name) is not None:
+                        stage[name].append(record[name])
+            elif record["type"] == "slowest":
+                slowest[record["stage"]] = record["items"]
+            elif record["type"] == "profile":
+                profile = record
+
+    columns = ("duration", "queue_wait", "fetch", "parse", "scrape")
+    print("{0:<20s} {1:>7s}".format("stage", "spans") + "".join(" {0:>19s}".format(c) for c in columns), file=out)
+    print("{0:<28s}".format("") + " {0:>19s}".format("p50 / p99 ms") * len(columns), file=out)
+    for name, stage in timings.items():
+        cells = []
+        for column in columns:
+            values = sorted(stage.get(column, []))
+            cells.append("-" if not values else "{0:.1f} / {1:.1f}".format(
+                quantile(values, 0.5) * 1000, quantile(values, 0.99) * 1000))
+        print("{0:<20s} {1:>7d}".format(name, len(stage["duration"])) +
+              "".join(" {0:>19s}".format(cell) for cell in cells), file=out)
+
+    for name, items in slowest.items():
+        print("\nSlowest items in {0}:".format(name), file=out)
+        for item in items:
+            print("  {0:>9.1f}ms  {1:<12s} {2}".format(item["duration"] * 1000, item["trace"], item["url"]), file=out)
+
+    if profile is not None:
+        print("\nCPU time ({0} samples every {1}s):".format(profile["samples"], profile["interval"]), file=out)
+        for name, value in sorted(profile["seconds"].items(), key=lambda kv: -kv[1]):
+            print("  {0:<30s} {1:>8.2f}s".format(name, value), file=out)
+        for name, value in sorted(profile["functions"].items(), key=lambda kv: -kv[1]):
+            print("    {0:<28s} {1:>8.2f}s".format(name, value), file=out)
@@ -0,0 +1,24 @@
+import urllib.parse
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url, drop_fragment=True, sort_query=True, drop_params=()):
+    # Turns equivalent spellings of a URL into the same string so they can be deduplicated
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = "{0}:{1}".format(host, parts.port)
+    if parts.username:
+        host = "{0}@{1}".format(parts.username, host)
+
+    query = parts.query
+    if sort_query or drop_params:
+        params = [(k, v) for k, v in urllib.parse.parse_qsl(query, keep_blank_values=True) if k not in drop_params]
+        query = urllib.parse.urlencode(sorted(params) if sort_query else params)
+
+    return urllib.parse.urlunsplit((
+        scheme, host, parts.path or "/", query, "" if drop_fragment else parts.fragment
+    ))
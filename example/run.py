@@ -1,13 +1,12 @@
-import asyncio
 import logging
 
 # Change this to logging.INFO to see more information. Setting it to logging.DEBUG is a bit too much.
 logging.basicConfig(level=logging.WARN)
 
 from example.scrapers.geoip import GeoIPScraper
-import json
 
 from cyborg import Pipeline
+from cyborg.sinks import JsonLinesSink
 from example.scrapers.justeat.area import AreaScraper
 from example.scrapers.justeat.takeaway import TakeawayScraper
 from example.scrapers.justeat.menu import MenuScraper
@@ -23,18 +22,16 @@ just_eat_pipeline = Pipeline()\
 
 
 def main():
-    with open("results", "w") as fd:
-        # Create our pipeline, pipe all the data through the GeoIPScraper
-        # Use the "display" plugin to give us a live overview of the status of the pipeline
-        # Output all the results in JSON to our "results" file, opened above.
-        pipe = just_eat_pipeline\
-            .pipe(GeoIPScraper)\
-            .use("display")\
-            .output(lambda o: fd.write(json.dumps(o) + "\n"))
-
-        # Run the pipeline
-        task = pipe.start()
-        asyncio.get_event_loop().run_until_complete(task)
+    # Create our pipeline, pipe all the data through the GeoIPScraper
+    # Use the "display" plugin to give us a live overview of the status of the pipeline
+    # Output all the results in JSON to our "results" file, written in batches off the event loop.
+    pipe = just_eat_pipeline\
+        .pipe(GeoIPScraper)\
+        .use("display")\
+        .output(JsonLinesSink("results", batch_size=100))
+
+    # Run the pipeline, Ctrl-C stops it after writing the results gathered so far
+    pipe.run()
 
 
 if __name__ ==  "__main__":
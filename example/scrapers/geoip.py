@@ -4,6 +4,7 @@ import urllib.parse
 
 class GeoIPScraper(BatchProcessor):
     BATCH_SIZE = 10
+    EXPECTS = "json"
 
     def process_batch(self, batch):
         subquery_format = "SELECT latitude,longitude FROM geo.placefinder WHERE text='{0}' LIMIT 1"
@@ -4,6 +4,7 @@ from cyborg import Page, Scraper
 class AreaScraper(Scraper):
 
     page_format = Page("/{input}-takeaways")
+    PARSE_DOCUMENT = True
 
     def scrape(self, data, response):
         for link_list in response.find(".links"):
@@ -2,6 +2,10 @@ from cyborg import Page, Scraper
 
 
 class MenuScraper(Scraper):
+    # Menus are the last pages of the crawl, so in incremental runs an unchanged menu has nothing new to give
+    SKIP_UNCHANGED = True
+    PARSE_DOCUMENT = True
+
     def scrape(self, data, response):
         takeaway_address = self.trim_whitespace(response.get(".restInfoAddress").text)
         takeaway_name = response.get(".restaurant-name").text
@@ -9,5 +9,6 @@ setup(
     author='Orf',
     author_email='tom@tomforb.es',
     description='',
+    python_requires='>=3.7',
     requires=["requests", 'aiohttp', 'lxml']
 )
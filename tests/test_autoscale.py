@@ -0,0 +1,26 @@
+import asyncio
+
+from cyborg.autoscale import Autoscaler
+
+
+class Stage(object):
+    def __init__(self, workers, busy_time, queued):
+        self.workers = workers
+        self.busy_time = busy_time
+        self.blocked_time = 0.0
+        self.input_queue = asyncio.Queue(10)
+        for item in range(queued):
+            self.input_queue.put_nowait(item)
+
+    def set_workers(self, workers):
+        self.workers = workers
+
+
+def test_rebalance_with_equally_idle_donors():
+    bottleneck = Stage(workers=4, busy_time=4.0, queued=10)
+    donors = [Stage(workers=4, busy_time=0.0, queued=1), Stage(workers=4, busy_time=0.0, queued=1)]
+
+    Autoscaler(max_workers=12).rebalance([bottleneck] + donors)
+
+    assert bottleneck.workers == 5
+    assert sorted(donor.workers for donor in donors) == [3, 4]
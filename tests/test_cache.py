@@ -0,0 +1,14 @@
+import asyncio
+
+from cyborg.cache import ResponseCache
+
+
+def test_cache_can_be_used_after_close(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+
+    async def use():
+        assert await cache.lookup("http://example.com/") is None
+        await cache.close()
+
+    asyncio.run(use())
+    asyncio.run(use())
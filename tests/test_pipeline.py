@@ -0,0 +1,18 @@
+from cyborg import Pipeline
+from cyborg.scraper import Processor
+
+
+class Double(Processor):
+    async def process(self, data, url):
+        return data * 2, url
+
+
+def test_rerun_processes_all_input():
+    output = []
+    pipeline = Pipeline().feed([(i, None) for i in range(10)]).pipe(Double, workers=2).output(output.append)
+
+    pipeline.run()
+    pipeline.run()
+
+    assert sorted(output) == sorted(list(range(0, 20, 2)) * 2)
+    assert pipeline.processed == 10